@@ -2,106 +2,248 @@ import librosa
 import numpy as np
 import json
 import argparse
+import bisect
+import os
 import sys
+from audiofeatures import load_features, frame_times, audio_hash, cache_path, HOP_LENGTH, N_FFT
+from cacheutil import atomic_write
+from musicanalyzer import spaced_candidates, onset_peaks
 
-def analyze_music_transitions(audio_path, num_slides, transition_time, fade_out_time):
+def min_gap_chain(times, min_gap, start=0):
     """
-    Analyze music file and generate slideshow timing based on musical features.
+    Keep each of the sorted times that is at least min_gap after the last kept one, beginning
+    with start. Each kept time jumps straight to the next one with a binary search, so the cost
+    grows with the times kept rather than with every candidate.
     """
-    # Load audio file
-    y, sr = librosa.load(audio_path, sr=None)
-    duration = librosa.get_duration(y=y, sr=sr)
-    
-    # Detect beats and tempo
-    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-    beat_times = librosa.frames_to_time(beats, sr=sr)
-    
-    # Detect onsets (new sounds/instruments)
-    onset_frames = librosa.onset.onset_detect(y=y, sr=sr)
-    onset_times = librosa.frames_to_time(onset_frames, sr=sr)
-    
-    # Detect spectral rolloff for major transitions
-    spectral_rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)[0]
+    times = np.asarray(times, dtype=float).tolist()
+    n = len(times)
+    kept = [start]
+    first = 0  # Only times after the last kept one are considered
+    while True:
+        last = kept[-1]
+        j = max(bisect.bisect_left(times, last + min_gap), first)
+        # The search compared against the rounded sum; settle on the exact first time with
+        # t - last >= min_gap, which only grows with t
+        while j > first and times[j - 1] - last >= min_gap:
+            j -= 1
+        while j < n and times[j] - last < min_gap:
+            j += 1
+        if j == n:
+            return kept
+        kept.append(times[j])
+        first = j + 1
+
+def transition_candidates(features):
+    """Return the sorted candidate transition times of a track from its audio features."""
+    # Beats
+    beat_times = frame_times(features, features["beats"])
+
+    # Onsets (new sounds/instruments)
+    onset_times = frame_times(features, features["onset_frames"])
+
+    # Spectral rolloff for major transitions
+    spectral_rolloff = features["rolloff"]
     rolloff_delta = np.diff(spectral_rolloff)
     rolloff_peaks = np.where(np.abs(rolloff_delta) > np.std(rolloff_delta) * 2)[0]
-    rolloff_times = librosa.frames_to_time(rolloff_peaks, sr=sr)
-    
+    rolloff_times = frame_times(features, rolloff_peaks)
+
     # Combine all transition points
-    all_transitions = np.unique(np.concatenate([
+    return np.unique(np.concatenate([
         beat_times[::4],  # Every 4th beat
         onset_times,
         rolloff_times
     ]))
-    
-    # Filter out transitions that are too close together
-    min_slide_duration = transition_time + 1.0  # Minimum 1 second display time
-    filtered_transitions = [0]  # Start at beginning
-    for t in all_transitions:
-        if t - filtered_transitions[-1] >= min_slide_duration:
-            filtered_transitions.append(t)
-    
-    # Ensure we have enough transition points for all slides
-    if len(filtered_transitions) < num_slides:
-        # Add evenly spaced transitions
-        available_duration = duration - fade_out_time
-        interval = available_duration / num_slides
-        filtered_transitions = [i * interval for i in range(num_slides)]
-    elif len(filtered_transitions) > num_slides:
-        # Select the most evenly distributed transitions
-        indices = np.linspace(0, len(filtered_transitions) - 1, num_slides, dtype=int)
-        filtered_transitions = [filtered_transitions[i] for i in indices]
-    
-    # Calculate slide durations
-    slides = []
-    min_last_slide_duration = 2.0  # Minimum 2 seconds for last slide
-    
-    for i in range(num_slides):
-        if i < num_slides - 1:
-            # Regular slide
-            start_time = filtered_transitions[i]
-            end_time = filtered_transitions[i + 1] if i + 1 < len(filtered_transitions) else duration
-            slide_duration = end_time - start_time - transition_time
-            
-            slides.append({
-                "duration": round(slide_duration, 3),
-                "transition": round(transition_time, 3)
-            })
+
+# Bump when transition_candidates or the saved analysis changes so stale saved analyses are rebuilt
+ANALYSIS_VERSION = 2
+# TrackAnalysis objects kept in memory; the least recently used are dropped beyond this
+MAX_ANALYSES = 32
+
+# In-process TrackAnalysis objects keyed by audio content hash, least recently used first
+_analyses = {}
+
+class TrackAnalysis:
+    """
+    Candidate transitions of one track, built once from its (cached) audio features or its
+    music index entry.
+
+    slides_for() answers timing queries for any slide count, transition time and fade out
+    time from the stored candidates without touching the audio again, so re-timing a
+    slideshow after changing those settings is interactive.
+    """
+
+    def __init__(self, audio_path, entry=None):
+        """
+        Args:
+            audio_path: Path to the audio file
+            entry: Current music index entry of the track (musicindex.track_info), whose
+                precomputed analysis is used instead of the audio features
+        """
+        if entry is not None:
+            self.duration = float(entry["duration"])
+            self.tempo = float(entry["tempo"])
+            self.beat_times = np.asarray(entry["beats"], dtype=float)
+            self.section_times = np.asarray(entry["sections"], dtype=float)
+            self.section_strength = np.asarray(entry["section_strength"], dtype=float)
+            self.candidates = np.asarray(entry["candidates"], dtype=float)
+            self.spaced_peaks = np.asarray(entry["spaced_peaks"], dtype=float)
+            self.spaced_candidates = np.asarray(entry["spaced_candidates"], dtype=float)
+            self.onset_peaks = np.asarray(entry["onset_peaks"], dtype=float)
         else:
-            # Last slide with fade out
-            start_time = filtered_transitions[i]
-            remaining_time = duration - start_time
-            slide_duration = remaining_time - fade_out_time
-            
-            # Ensure minimum duration for last slide
-            if slide_duration < min_last_slide_duration:
-                # Need to adjust previous slides to make room
-                shortage = min_last_slide_duration - slide_duration
-                
-                # Redistribute the shortage across previous slides
-                if num_slides > 1:
-                    reduction_per_slide = shortage / (num_slides - 1)
-                    for j in range(len(slides)):
-                        slides[j]["duration"] = round(slides[j]["duration"] - reduction_per_slide, 3)
-                
-                slide_duration = min_last_slide_duration
-            
-            slides.append({
-                "duration": round(slide_duration, 3),
-                "transition": round(fade_out_time, 3)
-            })
-    
-    # Verify total duration matches
-    total_slideshow_duration = sum(s["duration"] + s["transition"] for s in slides)
-    if abs(total_slideshow_duration - duration) > 0.01:
-        # Small adjustment to last slide to ensure exact match
-        adjustment = duration - total_slideshow_duration
-        slides[-1]["duration"] = round(slides[-1]["duration"] + adjustment, 3)
-    
-    return {
-        "slides": slides,
-        "total_duration": round(duration, 3),
-        #"detected_tempo": round(tempo, 1)
-    }
+            # Load (cached) audio features
+            features = load_features(audio_path)
+            self.duration = float(features["duration"])
+
+            # Beats and tempo
+            self.tempo = float(features["tempo"][0])
+            self.beat_times = frame_times(features, features["beats"])
+
+            # Section boundaries (verse, chorus...) and how strong each one is
+            self.section_times = frame_times(features, features["sections"])
+            self.section_strength = np.asarray(features["section_strength"])
+
+            self.candidates = transition_candidates(features)
+            # Candidates of the spaced and peaks timing strategies (musicanalyzer)
+            self.spaced_peaks, self.spaced_candidates = spaced_candidates(features)
+            self.onset_peaks = onset_peaks(features)
+        # Filtered transitions per minimum slide duration
+        self._filtered = {}
+
+    def to_entry(self):
+        """Return the analysis as arrays under the music index entry names TrackAnalysis accepts."""
+        return {
+            "duration": np.array(self.duration),
+            "tempo": np.array(self.tempo),
+            "beats": self.beat_times,
+            "sections": self.section_times,
+            "section_strength": self.section_strength,
+            "candidates": self.candidates,
+            "spaced_peaks": self.spaced_peaks,
+            "spaced_candidates": self.spaced_candidates,
+            "onset_peaks": self.onset_peaks,
+        }
+
+    def slides_for(self, num_slides, transition_time, fade_out_time):
+        """
+        Return the slideshow timing for num_slides slides: the structure analyze_music_transitions
+        returns.
+        """
+        duration = self.duration
+
+        # Filter out transitions that are too close together
+        min_slide_duration = transition_time + 1.0  # Minimum 1 second display time
+        if min_slide_duration not in self._filtered:
+            self._filtered[min_slide_duration] = min_gap_chain(self.candidates, min_slide_duration)  # Start at beginning
+        filtered_transitions = self._filtered[min_slide_duration]
+
+        # Ensure we have enough transition points for all slides
+        if len(filtered_transitions) < num_slides:
+            # Add evenly spaced transitions
+            available_duration = duration - fade_out_time
+            interval = available_duration / num_slides
+            filtered_transitions = [i * interval for i in range(num_slides)]
+        elif len(filtered_transitions) > num_slides:
+            # Select the most evenly distributed transitions
+            indices = np.linspace(0, len(filtered_transitions) - 1, num_slides, dtype=int)
+            filtered_transitions = [filtered_transitions[i] for i in indices]
+
+        # Calculate slide durations
+        slides = []
+        min_last_slide_duration = 2.0  # Minimum 2 seconds for last slide
+
+        for i in range(num_slides):
+            if i < num_slides - 1:
+                # Regular slide
+                start_time = filtered_transitions[i]
+                end_time = filtered_transitions[i + 1] if i + 1 < len(filtered_transitions) else duration
+                slide_duration = end_time - start_time - transition_time
+
+                slides.append({
+                    "duration": round(slide_duration, 3),
+                    "transition": round(transition_time, 3)
+                })
+            else:
+                # Last slide with fade out
+                start_time = filtered_transitions[i]
+                remaining_time = duration - start_time
+                slide_duration = remaining_time - fade_out_time
+
+                # Ensure minimum duration for last slide
+                if slide_duration < min_last_slide_duration:
+                    # Need to adjust previous slides to make room
+                    shortage = min_last_slide_duration - slide_duration
+
+                    # Redistribute the shortage across previous slides
+                    if num_slides > 1:
+                        reduction_per_slide = shortage / (num_slides - 1)
+                        for j in range(len(slides)):
+                            slides[j]["duration"] = round(slides[j]["duration"] - reduction_per_slide, 3)
+
+                    slide_duration = min_last_slide_duration
+
+                slides.append({
+                    "duration": round(slide_duration, 3),
+                    "transition": round(fade_out_time, 3)
+                })
+
+        # Verify total duration matches
+        total_slideshow_duration = sum(s["duration"] + s["transition"] for s in slides)
+        if abs(total_slideshow_duration - duration) > 0.01:
+            # Small adjustment to last slide to ensure exact match
+            adjustment = duration - total_slideshow_duration
+            slides[-1]["duration"] = round(slides[-1]["duration"] + adjustment, 3)
+
+        return {
+            "slides": slides,
+            "total_duration": round(duration, 3),
+            #"detected_tempo": round(tempo, 1)
+        }
+
+def _saved_analysis(audio_path):
+    """
+    Return the TrackAnalysis of audio_path, reading the one an earlier run saved next to the
+    cached features or building and saving it.
+
+    The saved analysis is a few arrays, so processes that each time one slideshow (the editor
+    runs scriptgen.py once per generation) skip loading the full features again.
+    """
+    path = cache_path(audio_path, {"hop_length": HOP_LENGTH, "n_fft": N_FFT, "analysis": ANALYSIS_VERSION})
+    if os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                return TrackAnalysis(audio_path, {name: data[name] for name in data.files})
+        except (OSError, ValueError, KeyError):
+            print(f"Warning: ignoring unreadable saved analysis {path}")
+    analysis = TrackAnalysis(audio_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, "wb") as f:
+        np.savez(f, **analysis.to_entry())
+    return analysis
+
+def track_analysis(audio_path, entry=None):
+    """
+    Return the TrackAnalysis of audio_path, building it once per track content.
+
+    entry is the track's current music index entry, if any: it supplies the content hash and
+    the precomputed analysis, so neither the audio nor its features are read. Otherwise the
+    analysis is saved in the feature cache for later processes. At most MAX_ANALYSES are kept
+    in memory.
+    """
+    key = entry["hash"] if entry is not None else audio_hash(audio_path)
+    analysis = _analyses.pop(key, None)
+    if analysis is None:
+        analysis = TrackAnalysis(audio_path, entry) if entry is not None else _saved_analysis(audio_path)
+    # Re-inserting moves the track to the most recently used end
+    _analyses[key] = analysis
+    while len(_analyses) > MAX_ANALYSES:
+        del _analyses[next(iter(_analyses))]
+    return analysis
+
+def analyze_music_transitions(audio_path, num_slides, transition_time, fade_out_time):
+    """
+    Analyze music file and generate slideshow timing based on musical features.
+    """
+    return track_analysis(audio_path).slides_for(num_slides, transition_time, fade_out_time)
 
 def main():
     parser = argparse.ArgumentParser(description='Analyze MP3 for slideshow timing')
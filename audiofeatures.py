@@ -0,0 +1,367 @@
+import hashlib
+import json
+import os
+import itertools
+import librosa
+import numpy as np
+import soundfile as sf
+from cacheutil import atomic_write
+from pcmcache import audio_hash, cached_pcm
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FEATURE_CACHE_DIR = os.path.join(SCRIPT_DIR, 'feature_cache')
+# Bump when extract_features changes so stale cache entries are ignored
+FEATURE_VERSION = 7
+HOP_LENGTH = 512
+N_FFT = 2048
+# Tracks at least this long (seconds) are analysed block by block with bounded memory;
+# STORYGEN_STREAM_MIN_DURATION overrides it
+STREAM_MIN_DURATION = float(os.environ.get("STORYGEN_STREAM_MIN_DURATION", "600"))
+# Streaming block sizes: decoded samples per read and STFT frames per spectrogram block
+STREAM_BLOCK_SIZE = 1 << 18
+STREAM_BLOCK_FRAMES = 1024
+# Structural segmentation: width of the checkerboard kernel in beats (half on each side of a
+# candidate boundary), the weakest novelty that counts as a section change (0 to 1) and the
+# shortest section kept (seconds)
+SECTION_KERNEL_BEATS = 16
+SECTION_MIN_NOVELTY = 0.2
+SECTION_MIN_DURATION = 6.0
+
+def decode_audio(audio_path):
+    """
+    Decode audio to a mono float32 signal at the file's native rate.
+
+    The samples come from the PCM cache (pcmcache.py), so a track is decoded once for analysis
+    and muxing alike; they are identical to what librosa.load reads, which decodes the file when
+    the cache is disabled.
+
+    Returns:
+        (y, sr)
+    """
+    pcm = cached_pcm(audio_path)
+    if pcm is not None:
+        samples, sr = pcm
+        return samples.mean(axis=1, dtype=np.float32), sr
+    return librosa.load(audio_path, sr=None, mono=True)
+
+def _contrast_bands(sr, n_fft, fmin=200.0, quantile=0.02):
+    """
+    Return the (bin mask, number of bins averaged) of every spectral contrast band, following
+    librosa.feature.spectral_contrast: octave bands from fmin, as many as fit below Nyquist
+    (6 at the usual 44.1 or 48 kHz).
+    """
+    n_bands = min(6, int(np.floor(np.log2(sr / 2 / fmin - 1e-9))))
+    freq = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+    octa = np.zeros(n_bands + 2)
+    octa[1:] = fmin * (2.0 ** np.arange(0, n_bands + 1))
+    bands = []
+    for k, (f_low, f_high) in enumerate(zip(octa[:-1], octa[1:])):
+        current_band = np.logical_and(freq >= f_low, freq <= f_high)
+        idx = np.flatnonzero(current_band)
+        if k > 0:
+            current_band[idx[0] - 1] = True
+        if k == n_bands:
+            current_band[idx[-1] + 1:] = True
+        bins = np.flatnonzero(current_band)
+        if k < n_bands:
+            bins = bins[:-1]
+        # Always take at least one bin from each side
+        bands.append((bins, int(np.maximum(np.rint(quantile * np.sum(current_band)), 1))))
+    return bands
+
+def _spectral_frames(S, mel_basis, chroma_basis, bands, sr, n_fft, hop_length):
+    """
+    Compute the per-frame features of a block of magnitude STFT frames.
+
+    Every value depends only on its own frame, so the in-memory and streaming paths get the same
+    numbers whether S holds the whole track or one block of it.
+
+    Returns:
+        Dict of mel_power (mel bands x frames), chroma (12 x frames), rolloff, and the
+        contrast peak/valley energies
+    """
+    peak = np.zeros((len(bands), S.shape[-1]))
+    valley = np.zeros_like(peak)
+    for k, (bins, idx) in enumerate(bands):
+        sortedr = np.sort(S[bins], axis=0)
+        valley[k] = np.mean(sortedr[:idx], axis=0)
+        peak[k] = np.mean(sortedr[-idx:], axis=0)
+    power = S ** 2
+    return {
+        "mel_power": np.dot(mel_basis, power),
+        "chroma": np.dot(chroma_basis, power),
+        "rolloff": librosa.feature.spectral_rolloff(S=S, sr=sr, n_fft=n_fft, hop_length=hop_length)[0],
+        "peak": peak,
+        "valley": valley,
+    }
+
+def _mel_flux(mel_db, previous=None):
+    """
+    Return the mean and median positive mel dB flux of every frame against the frame before it,
+    as librosa.onset.onset_strength aggregates it. previous is the last frame of the preceding
+    block; without it the first frame has no flux and is dropped.
+    """
+    if previous is not None:
+        mel_db = np.concatenate([previous[:, np.newaxis], mel_db], axis=1)
+    flux = np.maximum(0.0, mel_db[:, 1:] - mel_db[:, :-1])
+    return np.mean(flux, axis=0), np.median(flux, axis=0)
+
+def _estimate_tempo(onset_envelope, sr, hop_length, block_frames=STREAM_BLOCK_FRAMES):
+    """
+    Estimate the global tempo the way librosa.feature.tempo does (mean tempogram weighted by a
+    log-normal prior around 120 BPM), but accumulate the tempogram block_frames columns at a
+    time. The full tempogram is hundreds of times the size of the envelope and dominates
+    memory on long tracks.
+    """
+    win_length = librosa.time_to_frames(8.0, sr=sr, hop_length=hop_length).item()
+    ac_window = librosa.filters.get_window("hann", win_length, fftbins=True)[:, np.newaxis]
+    n = len(onset_envelope)
+    padded = np.pad(onset_envelope, win_length // 2, mode="linear_ramp", end_values=[0, 0])
+    tg_sum = np.zeros(win_length)
+    for start in range(0, n, block_frames):
+        stop = min(start + block_frames, n)
+        odf_frame = librosa.util.frame(padded[start:stop + win_length - 1], frame_length=win_length, hop_length=1)
+        tg = librosa.util.normalize(librosa.autocorrelate(odf_frame * ac_window, axis=-2), norm=np.inf, axis=-2)
+        tg_sum += tg.sum(axis=-1)
+
+    bpms = librosa.tempo_frequencies(win_length, hop_length=hop_length, sr=sr)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logprior = -0.5 * (np.log2(bpms) - np.log2(120.0)) ** 2
+    # Nothing above 320 BPM
+    logprior[:int(np.argmax(bpms < 320.0))] = -np.inf
+    return bpms[np.argmax(np.log1p(1e6 * tg_sum / n) + logprior)]
+
+def _section_boundaries(chroma, contrast, rms, beats, sr, hop_length, kernel_beats=SECTION_KERNEL_BEATS,
+                        min_novelty=SECTION_MIN_NOVELTY, min_duration=SECTION_MIN_DURATION):
+    """
+    Find section boundaries (verse, chorus, bridge...) with a self-similarity novelty curve.
+
+    Chroma (harmony) and spectral contrast plus loudness (timbre) are averaged per beat, and a
+    Gaussian tapered checkerboard kernel slid along the diagonal of their cosine self-similarity
+    scores how different the music before each beat is from the music after it. Only the band of
+    the matrix under the kernel is computed, so memory stays linear in the track length.
+
+    Returns:
+        (boundary frames, novelty of each boundary from 0 for no change to 1 for an abrupt one),
+        both sorted by frame
+    """
+    n_frames = chroma.shape[-1]
+    half = kernel_beats // 2
+    # Beat synchronous descriptors, or half second steps when there are too few beats
+    grid = beats if len(beats) >= kernel_beats else np.arange(0, n_frames, librosa.time_to_frames(0.5, sr=sr, hop_length=hop_length))
+    grid = librosa.util.fix_frames(grid, x_min=0, x_max=n_frames)
+    if len(grid) < 3:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    harmony = librosa.util.normalize(librosa.util.sync(chroma, grid, pad=False), norm=2, axis=0)
+    timbre = librosa.util.sync(np.vstack([contrast, librosa.amplitude_to_db(rms[np.newaxis], ref=np.max)]), grid, pad=False)
+    timbre = (timbre - timbre.mean(axis=1, keepdims=True)) / (timbre.std(axis=1, keepdims=True) + 1e-9)
+    timbre = librosa.util.normalize(timbre, norm=2, axis=0)
+    X = np.vstack([harmony, timbre]) / np.sqrt(2)
+
+    # Window j covers the half beats before and after the start of beat segment j
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(X, ((0, 0), (half, half)), mode="edge"), 2 * half, axis=1)
+    similarity = np.einsum("djk,djl->jkl", windows, windows)
+    side = np.concatenate([-np.ones(half), np.ones(half)])
+    taper = np.exp(-0.5 * (np.arange(-half, half) + 0.5) ** 2 / (half / 2) ** 2)
+    kernel = np.outer(side * taper, side * taper)
+    novelty = np.maximum(np.einsum("jkl,kl->j", similarity, kernel), 0) / np.abs(kernel).sum()
+
+    peaks = librosa.util.peak_pick(novelty, pre_max=half, post_max=half, pre_avg=2 * half, post_avg=2 * half,
+                                   delta=0.1, wait=half)
+    frames = grid[peaks]
+    # Drop weak changes and boundaries that would leave a section shorter than min_duration at either end
+    min_frames = librosa.time_to_frames(min_duration, sr=sr, hop_length=hop_length)
+    keep = (novelty[peaks] >= min_novelty) & (frames >= min_frames) & (frames <= n_frames - min_frames)
+    return frames[keep].astype(np.int64), novelty[peaks][keep]
+
+def _finish_features(onset_flux, beat_flux, frames, sr, hop_length, n_fft):
+    """Turn the accumulated per-frame values into the feature dict (see extract_features)."""
+    n_frames = len(frames["rolloff"])
+    # Shift the envelopes by the lag plus half a window, as onset_strength does for centred frames
+    pad_width = 1 + n_fft // (2 * hop_length)
+    onset_env = np.pad(onset_flux, (pad_width, 0))[:n_frames]
+    # beat_track uses a median-aggregated envelope of the same mel spectrogram
+    beat_env = np.pad(beat_flux, (pad_width, 0))[:n_frames]
+    tempo, beats = librosa.beat.beat_track(onset_envelope=beat_env, sr=sr, hop_length=hop_length,
+                                           bpm=_estimate_tempo(beat_env, sr, hop_length))
+    onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    contrast = librosa.power_to_db(frames["peak"]) - librosa.power_to_db(frames["valley"])
+    sections, section_strength = _section_boundaries(frames["chroma"], contrast, frames["rms"], beats, sr, hop_length)
+    return {
+        "tempo": np.atleast_1d(tempo).astype(np.float64),
+        "beats": np.asarray(beats, dtype=np.int64),
+        "onset_env": onset_env,
+        "onset_frames": np.asarray(onset_frames, dtype=np.int64),
+        "rolloff": frames["rolloff"],
+        "contrast": contrast,
+        "rms": frames["rms"],
+        "sections": sections,
+        "section_strength": section_strength,
+        "sr": np.array(sr),
+        "hop_length": np.array(hop_length),
+    }
+
+def _stft_features(stft_blocks, sr, hop_length, n_fft):
+    """
+    Compute the features from a callable returning a fresh iterator over a track's (STFT, RMS) blocks.
+
+    The mel spectrogram's dB floor is relative to its loudest value, so the blocks are walked
+    twice: the first pass collects the per-frame features and the peak mel power, the second
+    computes the onset envelopes against that floor. No spectrogram is kept, only a few values per frame.
+    """
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft)
+    chroma_basis = librosa.filters.chroma(sr=sr, n_fft=n_fft)
+    bands = _contrast_bands(sr, n_fft)
+    chunks = {"chroma": [], "rolloff": [], "rms": [], "peak": [], "valley": []}
+    max_power = None
+    for S, rms in stft_blocks():
+        block = _spectral_frames(S, mel_basis, chroma_basis, bands, sr, n_fft, hop_length)
+        block["rms"] = rms
+        for name in chunks:
+            chunks[name].append(block[name])
+        block_max = block["mel_power"].max()
+        max_power = block_max if max_power is None else max(max_power, block_max)
+    frames = {name: np.concatenate(values, axis=-1) for name, values in chunks.items()}
+
+    # Same clamp as power_to_db(top_db=80) applied to the whole mel spectrogram
+    floor = librosa.power_to_db(np.array(max_power), top_db=None) - 80.0
+    onset_flux, beat_flux = [], []
+    previous = None
+    for S, _ in stft_blocks():
+        mel_db = np.maximum(librosa.power_to_db(np.dot(mel_basis, S ** 2), top_db=None), floor)
+        mean_flux, median_flux = _mel_flux(mel_db, previous)
+        onset_flux.append(mean_flux)
+        beat_flux.append(median_flux)
+        previous = mel_db[:, -1]
+    return _finish_features(np.concatenate(onset_flux), np.concatenate(beat_flux), frames, sr, hop_length, n_fft)
+
+def extract_features(y, sr, hop_length=HOP_LENGTH, n_fft=N_FFT):
+    """
+    Compute every feature the music analyzers use from a decoded signal.
+
+    One magnitude STFT and one mel spectrogram are computed per track and every feature is
+    derived from them, instead of each librosa feature recomputing its own spectrogram.
+
+    Returns:
+        Dict of numpy arrays: tempo, beats (frames), onset_env, onset_frames, rolloff,
+        contrast, rms, sections (section boundary frames) and section_strength, plus sr,
+        hop_length and duration
+    """
+    # Frames go through the same fixed-size STFT blocks as stream_features so both paths agree bit for bit
+    blocks = list(_stft_blocks([y], n_fft, hop_length))
+    features = _stft_features(lambda: iter(blocks), sr, hop_length, n_fft)
+    features["duration"] = np.array(librosa.get_duration(y=y, sr=sr))
+    return features
+
+def audio_blocks(audio_path, block_size=STREAM_BLOCK_SIZE):
+    """
+    Yield the mono float32 signal of audio_path in blocks of about block_size samples.
+
+    The samples are identical to decode_audio's: each block of the cached decode (or of a
+    soundfile read, without the cache) is downmixed on its own.
+    """
+    pcm = cached_pcm(audio_path)
+    if pcm is not None:
+        samples, _ = pcm
+        blocks = (samples[i:i + block_size] for i in range(0, len(samples), block_size))
+    else:
+        blocks = sf.blocks(audio_path, blocksize=block_size, dtype="float32", always_2d=True)
+    for block in blocks:
+        yield block.mean(axis=1, dtype=np.float32)
+
+def _frame_block(y, n_fft, hop_length):
+    S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length, center=False))
+    rms = librosa.feature.rms(y=y, frame_length=n_fft, hop_length=hop_length, center=False)[0]
+    return S, rms
+
+def _stft_blocks(blocks, n_fft, hop_length, block_frames=STREAM_BLOCK_FRAMES):
+    """
+    Yield (magnitude STFT, RMS) of a block stream with the same centred framing (n_fft // 2
+    zeros on either side) as librosa.stft and librosa.feature.rms on the whole signal. The RMS
+    is taken from the samples of each frame, like rms(y=...), not from the spectrogram.
+
+    Every yielded block holds exactly block_frames frames (the last one fewer), however the
+    input is split, because the FFT rounds differently depending on how frames are batched.
+    """
+    padding = np.zeros(n_fft // 2, dtype=np.float32)
+    span = (block_frames - 1) * hop_length + n_fft
+    buffer = padding
+    for block in itertools.chain(blocks, [None]):
+        last = block is None
+        buffer = np.concatenate([buffer, padding if last else block])
+        while len(buffer) >= span:
+            yield _frame_block(buffer[:span], n_fft, hop_length)
+            buffer = buffer[block_frames * hop_length:]
+        if last and len(buffer) >= n_fft:
+            n_frames = 1 + (len(buffer) - n_fft) // hop_length
+            yield _frame_block(buffer[:(n_frames - 1) * hop_length + n_fft], n_fft, hop_length)
+
+def stream_features(audio_path, hop_length=HOP_LENGTH, n_fft=N_FFT):
+    """
+    Compute the same features as extract_features(*decode_audio(audio_path)) while holding
+    only one block of audio and spectrogram in memory at a time. The track is decoded twice.
+    """
+    pcm = cached_pcm(audio_path)
+    sr = pcm[1] if pcm is not None else sf.info(audio_path).samplerate
+    n_samples = 0
+
+    def stft_blocks():
+        nonlocal n_samples
+        n_samples = 0
+        for block in audio_blocks(audio_path):
+            n_samples += len(block)
+            yield block
+
+    features = _stft_features(lambda: _stft_blocks(stft_blocks(), n_fft, hop_length), sr, hop_length, n_fft)
+    features["duration"] = np.array(n_samples / sr)
+    return features
+
+def cache_path(audio_path, params):
+    """Return the feature cache file of audio_path for the given analysis parameters."""
+    key = json.dumps({"audio": audio_hash(audio_path), "version": FEATURE_VERSION, "params": params}, sort_keys=True)
+    return os.path.join(FEATURE_CACHE_DIR, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".npz")
+
+def _should_stream(audio_path):
+    """Stream tracks of at least STREAM_MIN_DURATION that soundfile can read block by block."""
+    try:
+        return sf.info(audio_path).duration >= STREAM_MIN_DURATION
+    except (sf.LibsndfileError, RuntimeError):
+        return False
+
+def load_features(audio_path, use_cache=True, streaming=None):
+    """
+    Return the analysis features of audio_path, decoding the audio only on a cache miss.
+
+    Features are cached as compressed NPZ files in feature_cache/, keyed by the audio content
+    hash and the analysis parameters, so renames and re-downloads of a track still hit.
+
+    Args:
+        audio_path: Path to the audio file
+        use_cache: Read and write the on-disk cache
+        streaming: Analyse with bounded memory (stream_features); None streams tracks of at
+            least STREAM_MIN_DURATION. Both paths give identical features.
+    """
+    params = {"hop_length": HOP_LENGTH, "n_fft": N_FFT}
+    path = cache_path(audio_path, params) if use_cache else None
+    if path and os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            print(f"Warning: ignoring unreadable feature cache {path}")
+
+    if streaming is None:
+        streaming = _should_stream(audio_path)
+    if streaming:
+        features = stream_features(audio_path)
+    else:
+        features = extract_features(*decode_audio(audio_path))
+    if path:
+        os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+        with atomic_write(path, "wb") as f:
+            np.savez_compressed(f, **features)
+    return features
+
+def frame_times(features, frames):
+    """Convert frame indices of the cached features to seconds."""
+    return librosa.frames_to_time(frames, sr=int(features["sr"]), hop_length=int(features["hop_length"]))
@@ -0,0 +1,75 @@
+import os
+import subprocess
+from moviepy.config import FFMPEG_BINARY
+from pcmcache import pcm_file
+
+# Audio formats that can be stream-copied into an MP4 container as-is
+MP4_COPY_EXTENSIONS = {".mp3", ".aac", ".m4a"}
+
+def can_copy_audio(audio_file, output_file):
+    """
+    Check whether the audio stream of audio_file can be copied into output_file without re-encoding.
+    """
+    audio_ext = os.path.splitext(audio_file)[1].lower()
+    output_ext = os.path.splitext(output_file)[1].lower()
+    return output_ext in (".mp4", ".m4v", ".mov") and audio_ext in MP4_COPY_EXTENSIONS
+
+def audio_input_args(audio_file, output_file, fade_out=0):
+    """
+    Build the ffmpeg input arguments for the music track.
+
+    When the audio is re-encoded anyway (faded, or not copyable into the container), ffmpeg reads
+    the cached decoded PCM instead of decoding the music file again; a stream copy reads the
+    original file.
+    """
+    if fade_out > 0 or not can_copy_audio(audio_file, output_file):
+        pcm = pcm_file(audio_file)
+        if pcm is not None:
+            path, sample_rate, channels = pcm
+            return ["-f", "f32le", "-ar", str(sample_rate), "-ac", str(channels), "-i", path]
+    return ["-i", audio_file]
+
+def audio_output_args(audio_file, output_file, duration, fade_out=0):
+    """
+    Build the ffmpeg output arguments that trim (and optionally fade) the audio stream.
+
+    The original stream is copied when the container allows it and no fade is requested,
+    otherwise the audio is filtered and encoded to AAC by ffmpeg.
+
+    Args:
+        audio_file: Path to the music file
+        output_file: Path of the file being written
+        duration: Length to trim the audio to (in seconds)
+        fade_out: Duration of the audio fade out at the end (in seconds)
+    """
+    args = ["-t", f"{duration:.3f}"]
+    if fade_out > 0:
+        fade_start = max(duration - fade_out, 0)
+        args += ["-af", f"afade=t=out:st={fade_start:.3f}:d={fade_out:.3f}", "-c:a", "aac", "-b:a", "192k"]
+    elif can_copy_audio(audio_file, output_file):
+        args += ["-c:a", "copy"]
+    else:
+        args += ["-c:a", "aac", "-b:a", "192k"]
+    return args
+
+def mux_audio(video_file, audio_file, output_file, duration, fade_out=0):
+    """
+    Mux a music track onto a silent video in a single ffmpeg pass.
+
+    The video stream is copied untouched, so only the audio stage does any work.
+
+    Args:
+        video_file: Path to the rendered video without audio
+        audio_file: Path to the music file
+        output_file: Path of the muxed output file
+        duration: Length to trim the audio to (in seconds)
+        fade_out: Duration of the audio fade out at the end (in seconds)
+    """
+    cmd = [FFMPEG_BINARY, "-y", "-loglevel", "error", "-i", video_file]
+    cmd += audio_input_args(audio_file, output_file, fade_out)
+    cmd += ["-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy"]
+    cmd += audio_output_args(audio_file, output_file, duration, fade_out)
+    cmd += ["-movflags", "+faststart", output_file]
+    print(f"Muxing audio {audio_file} into {output_file}")
+    subprocess.run(cmd, check=True)
+    return output_file
@@ -0,0 +1,351 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import librosa
+import numpy as np
+import soundfile as sf
+import audiofeatures
+from analyze_music_slideshow import min_gap_chain, TrackAnalysis
+import musicanalyzer
+import musicindex
+import pcmcache
+from musictiming import analyze_timing, TIMING_STRATEGIES
+
+VIDEO_FPS = 24
+
+# Synthetic tracks of the accuracy suite, as synth_track arguments: click tracks at known tempos,
+# tracks whose timbre changes at known times and a track long enough to be analysed streaming
+SYNTH_TRACKS = {
+    "click_90bpm": {"duration": 40.0, "bpm": 90, "section_times": (0,)},
+    "click_120bpm": {"duration": 40.0, "bpm": 120, "section_times": (0,)},
+    "click_150bpm": {"duration": 40.0, "bpm": 150, "section_times": (0,)},
+    "sections_120bpm": {"duration": 60.0, "bpm": 120, "section_times": (0, 15, 30, 45)},
+    "sections_100bpm": {"duration": 75.0, "bpm": 100, "section_times": (0, 14, 29, 47, 60)},
+    "long_128bpm": {"duration": 660.0, "bpm": 128, "section_times": tuple(range(0, 660, 60))},
+}
+# Synthetic tracks the streaming, cache and query benchmarks run on
+DETAIL_TRACKS = ("sections_120bpm",)
+# Accuracy gates: relative tempo error, and the largest distance (seconds) from a true section
+# change to the nearest detected section boundary
+TEMPO_TOLERANCE = 0.02
+SECTION_TOLERANCE = 0.75
+
+def synth_track(path, duration=60.0, bpm=120, section_times=(0, 15, 30, 45), sr=44100, seed=0, block_duration=10.0):
+    """
+    Write a synthetic stereo track: kick/hat clicks at bpm plus a tone bed (with its 2nd and 3rd
+    harmonics, as instruments have) that changes pitch and timbre at each of section_times.
+
+    The track is generated and written block_duration seconds at a time, so long tracks need
+    little memory.
+    """
+    rng = np.random.default_rng(seed)
+    period = 60.0 / bpm
+    pitches = [220, 330, 262, 392, 294, 440, 349, 196]
+    n_samples = int(duration * sr)
+    block_size = int(block_duration * sr)
+    with sf.SoundFile(path, "w", samplerate=sr, channels=2) as f:
+        for first in range(0, n_samples, block_size):
+            t = np.arange(first, min(first + block_size, n_samples)) / sr
+            # Kick on every beat, noise hat half way between beats
+            since_beat = np.mod(t, period)
+            y = np.where(since_beat < 0.05, np.sin(2 * np.pi * 80 * since_beat) * np.exp(-since_beat * 60), 0.0)
+            since_hat = np.mod(t - period / 2, period)
+            y += np.where((t >= period / 2) & (since_hat < 0.02),
+                          0.2 * rng.standard_normal(len(t)) * np.exp(-since_hat * 200), 0.0)
+            section = np.searchsorted(section_times, t, side="right") - 1
+            pitch = np.take(pitches, section % len(pitches))
+            y += 0.15 * sum(np.sin(2 * np.pi * harmonic * pitch * t) / harmonic for harmonic in (1, 2, 3)) / 1.5
+            y += np.where(section % 2 == 1, 0.05 * rng.standard_normal(len(t)), 0.0)
+            y = np.clip(0.3 * y, -1.0, 1.0)
+            f.write(np.stack([y, y], axis=1))
+    return path
+
+def slide_starts(result):
+    """Return the start time of every slide."""
+    return np.array([slide["start"] for slide in result["slides"]])
+
+def run_quiet(function, *args):
+    """Run function without its progress prints, returning (result, seconds)."""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    return result, time.perf_counter() - start
+
+def nearest_distances(reference, times):
+    """Distance (seconds) from each of times to the nearest of the sorted reference times."""
+    if len(reference) == 0:
+        return np.full(len(times), np.inf)
+    return np.abs(times - reference[musicanalyzer._nearest_indices(reference, times)])
+
+def benchmark_accuracy(path, num_slides, spec=None, section_snap=1.0):
+    """
+    Run every analyzer on path and report its runtime, peak traced memory, tempo error and how
+    closely its slide changes track the reference timing: mean distance to the nearest beat (or
+    click, kick or hat, of a synthetic track) in video frames and, with known section changes, the mean distance from each change to the
+    nearest slide change (also with section snapping). The features are extracted and cached
+    first, on a line of their own, so the analyzer rows time the analysis alone.
+
+    Args:
+        path: Audio file
+        num_slides: Number of slides
+        spec: synth_track arguments of a synthetic track, giving the true click grid, tempo and
+            section changes. Without it the detected beats are the reference and the tempo
+            and sections are not scored.
+        section_snap: section_snap of the snapped analyzer runs
+
+    Returns:
+        Whether the tempo and section boundaries are within TEMPO_TOLERANCE and SECTION_TOLERANCE,
+        and every timing's slide and transition frames add up exactly to the audio length in frames
+    """
+    features, seconds, peak = traced(audiofeatures.load_features, path)
+    print(f"  {'features':<18} {seconds * 1000:8.1f} ms {peak:7.1f} MB  decode, extract and cache")
+    if spec:
+        # Kicks and hats are both onsets the beat tracker may lock onto (it tends to pick the hats)
+        beats = np.arange(0, spec["duration"], 30.0 / spec["bpm"])
+        changes = np.array(spec["section_times"][1:], dtype=float)
+    else:
+        beats = audiofeatures.frame_times(features, features["beats"])
+        changes = np.zeros(0)
+
+    audio_frames = int(float(features["duration"]) * VIDEO_FPS)
+    frames_exact = True
+    runs = [(strategy, strategy, 0.0) for strategy in TIMING_STRATEGIES]
+    if len(changes):
+        runs += [(f"{strategy}+snap", strategy, section_snap) for strategy in TIMING_STRATEGIES]
+    for name, strategy, snap in runs:
+        result, seconds, peak = traced(analyze_timing, path, num_slides, 1.5, 3.0, strategy, snap, VIDEO_FPS)
+        slide_changes = slide_starts(result)[1:]
+        frames = sum(slide["frames"] + slide["transition_frames"] for slide in result["slides"])
+        frames_exact = frames_exact and frames == result["total_frames"] == audio_frames
+        row = f"  {name:<18} {seconds * 1000:8.1f} ms {peak:7.1f} MB  {result['tempo']:6.1f} BPM"
+        if spec:
+            row += f" (error {abs(result['tempo'] - spec['bpm']) / spec['bpm']:5.1%})"
+        if len(slide_changes):
+            row += f"  beat distance {np.mean(nearest_distances(beats, slide_changes)) * VIDEO_FPS:5.2f} frames"
+        if len(changes):
+            row += f"  section distance {np.mean(nearest_distances(slide_changes, changes)):5.2f}s"
+        print(row)
+
+    print(f"  {'frames':<18} every timing {'sums' if frames_exact else 'does not sum'} to the "
+          f"{audio_frames} audio frames  {'PASS' if frames_exact else 'FAIL'}")
+    found = audiofeatures.frame_times(features, features["sections"])
+    row = f"  {'sections':<18} {', '.join(f'{t:.2f}' for t in found) or 'none'}"
+    passed = frames_exact
+    if spec:
+        tempo_error = abs(float(features["tempo"][0]) - spec["bpm"]) / spec["bpm"]
+        tempo_passed = tempo_error <= TEMPO_TOLERANCE
+        passed = passed and tempo_passed
+        row = (f"  {'tempo':<18} {float(features['tempo'][0]):.1f} BPM (true {spec['bpm']}, error {tempo_error:.1%}) "
+               f"{'PASS' if tempo_passed else 'FAIL'}\n" + row)
+    if spec:
+        # Every true change found, and no boundary away from one
+        error = np.max(nearest_distances(found, changes), initial=0.0)
+        extra = int(np.sum(nearest_distances(changes, found) > SECTION_TOLERANCE))
+        sections_passed = error <= SECTION_TOLERANCE and extra == 0
+        passed = passed and sections_passed
+        row += (f"  (true {', '.join(f'{t:g}' for t in changes) or 'none'}: max error {error:.2f}s, {extra} extra) "
+                f"{'PASS' if sections_passed else 'FAIL'}")
+    print(row)
+    return passed
+
+def traced(function, *args):
+    """Run function, returning (result, seconds, peak traced allocation in MB)."""
+    tracemalloc.start()
+    try:
+        result, seconds = run_quiet(function, *args)
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def benchmark_streaming(path):
+    """
+    Compare bounded-memory streaming analysis with in-memory analysis: time, peak memory, and
+    whether every feature (and so every candidate transition) is identical. The RMS energy must
+    also equal librosa's time-domain rms(y=...) on the decoded signal.
+    """
+    in_memory, memory_time, memory_peak = traced(audiofeatures.load_features, path, False, False)
+    streamed, stream_time, stream_peak = traced(audiofeatures.load_features, path, False, True)
+    identical = in_memory.keys() == streamed.keys() and all(np.array_equal(in_memory[name], streamed[name]) for name in in_memory)
+    y, _ = audiofeatures.decode_audio(path)
+    reference_rms = librosa.feature.rms(y=y, frame_length=audiofeatures.N_FFT, hop_length=audiofeatures.HOP_LENGTH)[0]
+    rms_matches = np.array_equal(in_memory["rms"], reference_rms)
+    print(f"  streaming  in-memory {memory_time:6.2f}s {memory_peak:7.1f} MB  streamed {stream_time:6.2f}s "
+          f"{stream_peak:7.1f} MB  features {'identical PASS' if identical else 'differ FAIL'}  "
+          f"rms {'matches rms(y) PASS' if rms_matches else 'differs from rms(y) FAIL'}")
+    return identical and rms_matches
+
+def benchmark_pcm_cache(path, cache_dir):
+    """
+    Time decoding with and without the PCM cache (cold fills it, warm reads the memmap) and check
+    the decoded signal is identical.
+    """
+    saved = pcmcache.PCM_CACHE_DIR, pcmcache.PCM_CACHE_MAX_BYTES
+    pcmcache.PCM_CACHE_DIR = cache_dir
+    try:
+        pcmcache.PCM_CACHE_MAX_BYTES = 0
+        (direct, _), direct_time = run_quiet(audiofeatures.decode_audio, path)
+        pcmcache.PCM_CACHE_MAX_BYTES = saved[1]
+        _, cold_time = run_quiet(audiofeatures.decode_audio, path)
+        (cached, _), warm_time = run_quiet(audiofeatures.decode_audio, path)
+        identical = np.array_equal(direct, cached)
+    finally:
+        pcmcache.PCM_CACHE_DIR, pcmcache.PCM_CACHE_MAX_BYTES = saved
+    print(f"  pcm cache  decode {direct_time:.3f}s cold {cold_time:.3f}s warm {warm_time:.3f}s  "
+          f"{'identical PASS' if identical else 'differ FAIL'}")
+    return identical
+
+def spacing_cost(candidates, selected, ideal_spacing):
+    return float(np.sum((np.diff(candidates[selected]) - ideal_spacing) ** 2))
+
+def benchmark_selection(num_slides=60, candidate_counts=(100, 500, 2000, 5000), seed=0):
+    """
+    Time the exact and window-pruned spaced point selectors on random candidates (about ten per
+    second of music) and check the pruned selection is as good as the exact one when it exists.
+    """
+    print(f"\nSpaced point selection ({num_slides} slides)")
+    rng = np.random.default_rng(seed)
+    passed = True
+    for n_candidates in candidate_counts:
+        duration = n_candidates / 10.0
+        candidates = np.unique(np.concatenate(([0.0], rng.uniform(0, duration, n_candidates - 1))))
+        ideal_spacing = duration / (num_slides + 2)
+        exact, exact_time = run_quiet(musicanalyzer._select_best_spaced_points_exact, candidates, num_slides + 1, ideal_spacing)
+        pruned, pruned_time = run_quiet(musicanalyzer._select_best_spaced_points_pruned, candidates, num_slides + 1, ideal_spacing, ideal_spacing / 2)
+        exact_cost = spacing_cost(candidates, exact, ideal_spacing)
+        if pruned is None:
+            result = "pruned: no selection within the window"
+        else:
+            pruned_cost = spacing_cost(candidates, pruned, ideal_spacing)
+            optimal = np.isclose(pruned_cost, exact_cost)
+            passed = passed and optimal
+            result = f"pruned cost {pruned_cost:.4f} {'PASS' if optimal else 'FAIL'}"
+        print(f"  {len(candidates):>5} candidates  exact {exact_time * 1000:7.1f} ms  pruned {pruned_time * 1000:7.1f} ms  "
+              f"exact cost {exact_cost:.4f}  {result}")
+    return passed
+
+def benchmark_queries(path):
+    """Time building a TrackAnalysis and answering timing queries from it."""
+    analysis, build_time = run_quiet(TrackAnalysis, path)
+    queries = [(num_slides, transition_time, fade_out_time)
+               for num_slides in (8, 17, 40, 60) for transition_time in (0.5, 1.0, 1.5) for fade_out_time in (0.0, 3.0)]
+    start = time.perf_counter()
+    for query in queries:
+        analysis.slides_for(*query)
+    query_time = (time.perf_counter() - start) / len(queries)
+    print(f"  queries    build {build_time:6.3f}s  {len(analysis.candidates)} candidates  "
+          f"{query_time * 1000:.3f} ms per slides_for query")
+
+def loop_nearest_indices(sorted_values, targets):
+    """The per-target argmin loop find_transition_points used before _nearest_indices."""
+    return np.array([np.argmin(np.abs(sorted_values - target)) for target in targets], dtype=int)
+
+def loop_min_gap_chain(times, min_gap):
+    """The loop analyze_music_transitions used before min_gap_chain."""
+    kept = [0]
+    for t in times:
+        if t - kept[-1] >= min_gap:
+            kept.append(t)
+    return kept
+
+def check_candidate_building(paths, trials=500, seed=0):
+    """
+    Check the vectorized nearest index lookup and the binary search min_gap_chain return exactly
+    what the loops they replaced did, on the frame, beat and candidate times of each track and on
+    random inputs full of ties.
+    """
+    cases = []
+    chains = []
+    for path in paths:
+        features = audiofeatures.load_features(path)
+        novelty_times = audiofeatures.frame_times(features, np.arange(len(features["onset_env"])))
+        beat_times = audiofeatures.frame_times(features, features["beats"])
+        cases.append((novelty_times, beat_times))
+        candidates = TrackAnalysis(path).candidates
+        chains += [(candidates, transition_time + 1.0) for transition_time in (0.5, 1.0, 1.5, 2.0)]
+    rng = np.random.default_rng(seed)
+    for _ in range(trials):
+        # Coarse grids make exact ties between neighbours common
+        grid = rng.choice([0.1, 0.25, 0.5, 1 / 3])
+        values = np.unique(rng.integers(0, 200, rng.integers(1, 60)) * grid)
+        targets = rng.integers(-10, 220, rng.integers(0, 40)) * grid / 2
+        cases.append((values, targets))
+        chains.append((values, rng.choice([0.1, 0.5, 1.1, 2.5]) * grid * 10))
+
+    mismatches = 0
+    for values, targets in cases:
+        if not np.array_equal(musicanalyzer._nearest_indices(values, targets), loop_nearest_indices(values, targets)):
+            mismatches += 1
+    for times, min_gap in chains:
+        if min_gap_chain(times, min_gap) != loop_min_gap_chain(times, min_gap):
+            mismatches += 1
+    # Candidate counts of a long, busy track
+    times = np.unique(rng.uniform(0, 600, 20000))
+    loop_ms = run_quiet(loop_min_gap_chain, times, 2.5)[1] * 1000
+    chain_ms = run_quiet(min_gap_chain, times, 2.5)[1] * 1000
+    print(f"\nCandidate building: {len(cases) + len(chains)} cases, {mismatches} mismatches against the original loops  "
+          f"{'PASS' if mismatches == 0 else 'FAIL'}")
+    print(f"  min_gap_chain on {len(times)} candidates: loop {loop_ms:.2f} ms  binary search {chain_ms:.2f} ms")
+    return mismatches == 0
+
+def check_index_timing(paths, num_slides):
+    """
+    Check a music index entry, as read back from the JSON index, gives the same analysis as the
+    audio features, and that the spaced and peaks strategies, which time slides from that
+    analysis, match the musicanalyzer functions reading the features.
+    """
+    mismatches = 0
+    for path in paths:
+        from_features = TrackAnalysis(path).to_entry()
+        entry = json.loads(json.dumps(run_quiet(musicindex.analyze_track, path)[0]))
+        from_index = TrackAnalysis(path, entry).to_entry()
+        mismatches += sum(not np.array_equal(from_features[name], from_index[name]) for name in from_features)
+        for strategy, direct in (("spaced", musicanalyzer.find_transition_points), ("peaks", musicanalyzer.analyze_audio)):
+            if run_quiet(TIMING_STRATEGIES[strategy], path, num_slides, 1.5, 3.0)[0] != run_quiet(direct, path, num_slides, 1.5, 3.0)[0]:
+                mismatches += 1
+    print(f"\nIndexed timing: {len(paths)} tracks, {mismatches} mismatches against the features  "
+          f"{'PASS' if mismatches == 0 else 'FAIL'}")
+    return mismatches == 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark music analyzers on real or synthetic audio')
+    parser.add_argument('audio_files', nargs='*', help='Audio files to benchmark (default: the synthetic SYNTH_TRACKS suite)')
+    parser.add_argument('--num-slides', type=int, default=17, help='Number of slides')
+    parser.add_argument('--quick', action='store_true', help='Skip the long synthetic track')
+    args = parser.parse_args()
+
+    # Warm up librosa's numba kernels so the first timed extraction is not dominated by JIT compilation
+    run_quiet(audiofeatures.extract_features, np.random.default_rng(0).standard_normal(22050 * 5).astype(np.float32), 22050)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Scratch caches, so every track starts cold and the real caches are left alone
+        audiofeatures.FEATURE_CACHE_DIR = os.path.join(tmp_dir, "feature_cache")
+        pcmcache.PCM_CACHE_DIR = os.path.join(tmp_dir, "pcm_cache")
+        if args.audio_files:
+            tracks = {os.path.basename(path): (path, None) for path in args.audio_files}
+        else:
+            tracks = {name: (synth_track(os.path.join(tmp_dir, f"{name}.wav"), **spec), spec)
+                      for name, spec in SYNTH_TRACKS.items()
+                      if not (args.quick and spec["duration"] >= audiofeatures.STREAM_MIN_DURATION)}
+        passed = True
+        for name, (path, spec) in tracks.items():
+            print(f"\n{name} ({args.num_slides} slides)")
+            passed = benchmark_accuracy(path, args.num_slides, spec) and passed
+            if spec is None or name in DETAIL_TRACKS:
+                passed = benchmark_streaming(path) and passed
+                passed = benchmark_pcm_cache(path, os.path.join(tmp_dir, "pcm_cache_check")) and passed
+                benchmark_queries(path)
+        passed = check_candidate_building([path for path, _ in tracks.values()]) and passed
+        passed = check_index_timing([path for path, _ in tracks.values()], args.num_slides) and passed
+    passed = benchmark_selection() and passed
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import contextlib
+import glob
+import os
+import tempfile
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Open a temporary file next to path and move it over path once the block completes.
+
+    A concurrent reader sees either the previous file or the complete new one, never a half
+    written one; if the block raises, the temporary file is removed and path is left untouched.
+
+    Args:
+        path: File to (re)write
+        mode: "w" for text or "wb" for bytes
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+def evict_lru(pattern, max_bytes, keep=None):
+    """
+    Delete the least recently used files matching pattern until they fit in max_bytes.
+
+    Files are ordered by modification time, so caches mark an entry as used with os.utime.
+
+    Args:
+        pattern: Glob of the cache entries
+        max_bytes: Total size the entries may take
+        keep: Entry never deleted (typically the one just written)
+
+    Returns:
+        List of (path, size) of the deleted entries
+    """
+    entries = []
+    for path in glob.glob(pattern):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted.append((path, size))
+    return evicted
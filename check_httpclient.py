@@ -0,0 +1,100 @@
+import datetime
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import requests
+import httpclient
+
+ONE_DAY = datetime.timedelta(days=1)
+
+class CatalogHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /catalog.json with an ETag and Last-Modified, answering conditional requests with 304."""
+    body = b'{"tracks": []}'
+    etag = '"v1"'
+    last_modified = "Mon, 05 Oct 2026 12:00:00 GMT"
+    # (path, request headers) of every request received
+    requests = []
+
+    def do_GET(self):
+        CatalogHandler.requests.append((self.path, dict(self.headers)))
+        if self.path != "/catalog.json":
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Last-Modified", self.last_modified)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+def check(name, ok):
+    print(f"  {name:<60} {'PASS' if ok else 'FAIL'}")
+    return ok
+
+def main():
+    """
+    Run fetch_file against a local http.server: a first download, a fresh copy that is not
+    requested, a conditional request answered 304 with the stored validators, a changed file
+    and a 404. Prints PASS/FAIL per step and exits non-zero if any fails.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CatalogHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    passed = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "catalog.json")
+            url = f"{base_url}/catalog.json"
+            print("fetch_file against a local server")
+
+            written = httpclient.fetch_file(url, path, ONE_DAY)
+            with open(path, "rb") as f:
+                passed = check("200 writes the file", written and f.read() == CatalogHandler.body) and passed
+            validators = httpclient._load_validators(path)
+            passed = check("validators stored", validators.get("etag") == CatalogHandler.etag
+                           and validators.get("last_modified") == CatalogHandler.last_modified) and passed
+
+            count = len(CatalogHandler.requests)
+            written = httpclient.fetch_file(url, path, ONE_DAY)
+            passed = check("fresh copy is not requested", not written and len(CatalogHandler.requests) == count) and passed
+
+            mtime_ns = os.stat(path).st_mtime_ns
+            checked = validators["checked"]
+            written = httpclient.fetch_file(url, path, ONE_DAY, force=True)
+            headers = CatalogHandler.requests[-1][1]
+            passed = check("conditional request sends the stored validators",
+                           headers.get("If-None-Match") == CatalogHandler.etag
+                           and headers.get("If-Modified-Since") == CatalogHandler.last_modified) and passed
+            passed = check("304 leaves the file untouched", not written and os.stat(path).st_mtime_ns == mtime_ns) and passed
+            passed = check("304 records the check", httpclient._load_validators(path).get("checked", 0) > checked) and passed
+
+            CatalogHandler.body, CatalogHandler.etag = b'{"tracks": [1]}', '"v2"'
+            written = httpclient.fetch_file(url, path, ONE_DAY, force=True)
+            with open(path, "rb") as f:
+                passed = check("changed file is written again", written and f.read() == CatalogHandler.body) and passed
+
+            missing = os.path.join(tmp_dir, "missing.json")
+            try:
+                httpclient.fetch_file(f"{base_url}/missing.json", missing)
+                raised = False
+            except requests.HTTPError as e:
+                raised = e.response.status_code == 404
+            passed = check("404 raises and writes nothing", raised and not os.path.exists(missing)) and passed
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f"\n{'PASS' if passed else 'FAIL'}")
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
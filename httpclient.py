@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cacheutil import atomic_write
+
+# (connect, read) timeouts of every request, in seconds
+HTTP_TIMEOUT = (10, 60)
+# Attempts after the first for connection errors and 429/5xx responses, waiting
+# HTTP_BACKOFF * 2^n seconds between them
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+# Connections kept open per host, enough for the parallel MP3 downloads
+HTTP_POOL_SIZE = 8
+
+_session = None
+_session_lock = threading.Lock()
+
+def session():
+    """Return the process wide session, with keep-alive connection pooling and retries."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset({"GET", "HEAD"}), raise_on_status=False)
+            adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+def get(url, stream=False, headers=None):
+    """GET url with the shared session, its timeouts and retries."""
+    return session().get(url, stream=stream, headers=headers, timeout=HTTP_TIMEOUT)
+
+def _validators_path(path):
+    # The ETag and Last-Modified of a downloaded file, and when they were last checked
+    return path + ".http.json"
+
+def _load_validators(path):
+    try:
+        with open(_validators_path(path), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_validators(path, validators):
+    with open(_validators_path(path), "w") as f:
+        json.dump(validators, f)
+
+def is_fresh(path, max_age):
+    """Return whether path was downloaded or found unchanged on the server within max_age (a timedelta)."""
+    if not os.path.exists(path):
+        return False
+    checked = _load_validators(path).get("checked", os.path.getmtime(path))
+    return time.time() - checked < max_age.total_seconds()
+
+def fetch_file(url, path, max_age=None, force=False, check=None):
+    """
+    Download url to path unless the local copy is current.
+
+    Nothing is requested while the copy is younger than max_age. After that, the request is
+    conditional on the ETag and Last-Modified of the copy, so an unchanged file costs a 304
+    and is neither written nor touched (its modification time still says when it changed).
+
+    Args:
+        url: URL to download
+        path: Local file
+        max_age: timedelta during which the local copy is used without asking (None: always ask)
+        force: Ask the server even if the copy is younger than max_age
+        check: Called with the downloaded bytes before they replace the copy; raise to reject them
+
+    Returns:
+        True if path was (re)written
+    """
+    if not force and max_age is not None and is_fresh(path, max_age):
+        return False
+    validators = _load_validators(path) if os.path.exists(path) else {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    print(f"Fetching {url}...")
+    resp = get(url, headers=headers)
+    if resp.status_code == 304:
+        print(f"{os.path.basename(path)} is unchanged")
+        _save_validators(path, dict(validators, checked=time.time()))
+        return False
+    resp.raise_for_status()
+    if check is not None:
+        check(resp.content)
+    with atomic_write(path, "wb") as f:
+        f.write(resp.content)
+    _save_validators(path, {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"),
+                            "checked": time.time()})
+    return True
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import time
+from cacheutil import atomic_write, evict_lru
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LLM_CACHE_DIR = os.path.join(SCRIPT_DIR, 'llm_cache')
+# Responses older than this are requested again; STORYGEN_LLM_CACHE_TTL_HOURS overrides it
+LLM_CACHE_TTL = float(os.environ.get("STORYGEN_LLM_CACHE_TTL_HOURS", "168")) * 3600
+# Total size of the cached responses before the least recently used are evicted;
+# STORYGEN_LLM_CACHE_MB overrides it, 0 disables the cache
+LLM_CACHE_MAX_BYTES = int(float(os.environ.get("STORYGEN_LLM_CACHE_MB", "64")) * 2 ** 20)
+# Sample every call again (still storing the new responses), see set_fresh
+FRESH = os.environ.get("STORYGEN_LLM_FRESH", "") not in ("", "0")
+
+def set_fresh(fresh=True):
+    """Make every following call sample the model again instead of reusing a cached response."""
+    global FRESH
+    FRESH = fresh
+
+def request_key(model, input, **params):
+    """Return the cache key of a request: a hash of the model, the prompt and the sampling parameters."""
+    request = {"model": model, "input": input, "params": params}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _entry_path(key):
+    return os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+def lookup(key):
+    """Return the cached response text for key, or None if it is missing or older than LLM_CACHE_TTL."""
+    path = _entry_path(key)
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+        if time.time() - entry["created"] > LLM_CACHE_TTL:
+            return None
+        # Mark as recently used for eviction
+        os.utime(path)
+        return entry["output_text"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def discard(model, input, **params):
+    """Forget the cached response of a request, e.g. when it could not be parsed."""
+    try:
+        os.remove(_entry_path(request_key(model, input, **params)))
+    except OSError:
+        pass
+
+def evict(max_bytes=LLM_CACHE_MAX_BYTES, keep=None):
+    """Delete the least recently used responses until the cache fits in max_bytes (never keep)."""
+    evict_lru(os.path.join(LLM_CACHE_DIR, "*.json"), max_bytes, keep)
+
+def store(key, model, output_text):
+    """Store a response for key and evict old responses if the cache is over its size."""
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    path = _entry_path(key)
+    with atomic_write(path) as f:
+        json.dump({"model": model, "created": time.time(), "output_text": output_text}, f)
+    evict(keep=path)
+
+def response_text(client, model, input, fresh=False, **params):
+    """
+    Return the output text of client.responses.create, reusing a cached response when possible.
+
+    Responses are cached on disk by model, prompt and sampling parameters, so re-running a
+    story skips every call whose inputs did not change.
+
+    Args:
+        client: OpenAI client
+        model: Model name
+        input: Prompt
+        fresh: Sample again even if a response is cached (the new one replaces it); also
+            forced by set_fresh or STORYGEN_LLM_FRESH=1
+        **params: Sampling parameters passed on to responses.create (temperature...)
+
+    Returns:
+        The response's output text
+    """
+    enabled = LLM_CACHE_MAX_BYTES > 0
+    key = request_key(model, input, **params)
+    if enabled and not (fresh or FRESH):
+        cached = lookup(key)
+        if cached is not None:
+            print(f"Reusing cached {model} response")
+            return cached
+    output_text = client.responses.create(model=model, input=input, **params).output_text
+    if enabled:
+        try:
+            store(key, model, output_text)
+        except OSError as e:
+            print(f"Warning: could not cache the {model} response ({e})")
+    return output_text
@@ -2,64 +2,143 @@ import os
 import librosa
 import numpy as np
 import json
+from audiofeatures import load_features, frame_times
 
-def _select_best_spaced_points(candidates, n_points, total_duration):
-    """Select n_points from candidates with optimal spacing."""
+def _nearest_indices(sorted_values, targets):
+    """
+    Return the index of the value nearest to each target in sorted_values, the lower one on ties,
+    i.e. np.argmin(np.abs(sorted_values - target)) for every target, in O(log n) each.
+    """
+    if len(sorted_values) == 1:
+        return np.zeros(len(targets), dtype=int)
+    right = np.clip(np.searchsorted(sorted_values, targets), 1, len(sorted_values) - 1)
+    left = right - 1
+    take_left = np.abs(sorted_values[left] - targets) <= np.abs(sorted_values[right] - targets)
+    return np.where(take_left, left, right)
+
+# Above this many candidates _select_best_spaced_points switches to the window-pruned variant
+PRUNE_MIN_CANDIDATES = 1000
+
+def _backtrack(back, last):
+    """Follow back pointers from the last selected candidate to the first."""
+    selected = [last]
+    for j in range(len(back) - 1, 0, -1):
+        selected.append(back[j][selected[-1]])
+    return np.array(selected[::-1])
+
+def _select_best_spaced_points_exact(candidates, n_points, ideal_spacing):
+    """
+    Exact O(n*k) selection, see _select_best_spaced_points.
+
+    cost[j][i] = min over p < i of cost[j-1][p] + (c[i] - c[p] - s)^2. Expanding the square
+    leaves (c[i] - s)^2 plus the minimum over lines m*x + b with m = -2*c[p],
+    b = c[p]^2 + cost[j-1][p], evaluated at x = c[i] - s. Candidates are sorted, so lines are
+    added with falling slopes and queried at rising x, and a monotone convex hull answers a whole
+    layer in O(n).
+    """
+    c = [float(t) for t in candidates]
+    n_candidates = len(c)
+    cost = [np.inf] * n_candidates
+    cost[0] = 0.0  # The selection starts with the first candidate
+    back = [None] * n_points
+    for j in range(1, n_points):
+        new_cost = [np.inf] * n_candidates
+        back[j] = [0] * n_candidates
+        hull = []  # (slope, intercept, candidate), hull[head:] is the live part
+        head = 0
+        # Leave room for the n_points - 1 - j points that still follow
+        for i in range(j, n_candidates - (n_points - 1 - j)):
+            p = i - 1
+            if cost[p] < np.inf:
+                m, b = -2.0 * c[p], c[p] * c[p] + cost[p]
+                while len(hull) - head >= 2:
+                    m1, b1, _ = hull[-2]
+                    m2, b2, _ = hull[-1]
+                    # The last line is never the minimum once the new one overtakes it no later than it overtook the one before
+                    if (b - b1) * (m1 - m2) <= (b2 - b1) * (m1 - m):
+                        hull.pop()
+                    else:
+                        break
+                hull.append((m, b, p))
+            if len(hull) == head:
+                continue
+            x = c[i] - ideal_spacing
+            while len(hull) - head >= 2 and hull[head + 1][0] * x + hull[head + 1][1] <= hull[head][0] * x + hull[head][1]:
+                head += 1
+            m, b, p = hull[head]
+            new_cost[i] = x * x + m * x + b
+            back[j][i] = p
+        cost = new_cost
+    return _backtrack(back, int(np.argmin(cost)))
+
+def _select_best_spaced_points_pruned(candidates, n_points, ideal_spacing, window):
+    """
+    Vectorized selection that only considers spacings within window seconds of ideal_spacing,
+    for thousands of candidates. Optimal among those selections; returns None if none exists.
+    """
+    c = np.asarray(candidates, dtype=np.float64)
+    n_candidates = len(c)
+    # Predecessors of candidate i lie in [lo[i], hi[i])
+    lo = np.searchsorted(c, c - ideal_spacing - window, side="left")
+    hi = np.minimum(np.searchsorted(c, c - ideal_spacing + window, side="right"), np.arange(n_candidates))
+    width = max(int(np.max(hi - lo)), 1)
+    predecessors = lo[:, np.newaxis] + np.arange(width)
+    valid = predecessors < hi[:, np.newaxis]
+    predecessors = np.where(valid, predecessors, 0)
+    spacing_cost = np.where(valid, (c[:, np.newaxis] - c[predecessors] - ideal_spacing) ** 2, np.inf)
+
+    cost = np.full(n_candidates, np.inf)
+    cost[0] = 0.0
+    back = [None] * n_points
+    for j in range(1, n_points):
+        total = cost[predecessors] + spacing_cost
+        best = np.argmin(total, axis=1)
+        back[j] = predecessors[np.arange(n_candidates), best]
+        cost = total[np.arange(n_candidates), best]
+    if not np.isfinite(cost).any():
+        return None
+    return _backtrack(back, int(np.argmin(cost)))
+
+def _select_best_spaced_points(candidates, n_points, total_duration, window=None):
+    """
+    Select n_points from candidates with optimal spacing.
+
+    Returns the indices of the selection that starts with the first candidate and minimizes the
+    sum of squared differences between consecutive spacings and total_duration / (n_points + 1).
+
+    Args:
+        candidates: Sorted candidate times in seconds
+        n_points: Number of points to select
+        total_duration: Duration the ideal spacing is derived from (seconds)
+        window: Only allow spacings within this many seconds of the ideal one and return None
+            if no selection fits. Without a window the selection is unconstrained.
+    """
     if n_points >= len(candidates):
         return np.arange(len(candidates))
-    
+
     ideal_spacing = total_duration / (n_points + 1)
-    n_candidates = len(candidates)
-    
-    # Dynamic programming to find best selection
-    dp = {}
-    
-    def score(indices):
-        if len(indices) < 2:
-            return 0
-        spacings = np.diff(candidates[indices])
-        return -np.sum((spacings - ideal_spacing) ** 2)
-    
-    # Greedy approximation for efficiency
-    selected = [0]  # Start with first candidate
-    for _ in range(n_points - 1):
-        best_next = -1
-        best_score = -np.inf
-        for i in range(selected[-1] + 1, n_candidates):
-            temp_selected = selected + [i]
-            temp_score = score(np.array(temp_selected))
-            if temp_score > best_score:
-                best_score = temp_score
-                best_next = i
-        if best_next >= 0:
-            selected.append(best_next)
-    
-    return np.array(selected)
+    if window is not None:
+        return _select_best_spaced_points_pruned(candidates, n_points, ideal_spacing, window)
+    if len(candidates) > PRUNE_MIN_CANDIDATES:
+        # Optimal selections rarely stray far from the ideal spacing, so try the fast variant first
+        selected = _select_best_spaced_points_pruned(candidates, n_points, ideal_spacing, ideal_spacing / 2)
+        if selected is not None:
+            return selected
+    return _select_best_spaced_points_exact(candidates, n_points, ideal_spacing)
 
-def find_transition_points(filename, num_slides, transition_duration=1.5, fade_duration=3.0):
+def spaced_candidates(features):
     """
-    Find optimal transition points in music based on rhythm, beats, and musical changes.
-    
-    Args:
-        filename: Path to audio file
-        num_slides: Number of slides to transition between
-        transition_duration: Duration of transitions between slides (seconds)
-        fade_duration: Duration of fade to black for final slide (seconds)
-    
-    Returns:
-        List of transition start times in seconds
+    Return (peak_times, candidates) of a track for find_transition_points: the peaks of the
+    combined onset and spectral contrast novelty, and those peaks with the beats that coincide
+    with high novelty, sorted.
     """
-    y, sr = librosa.load(filename, sr=None)
-    
-    # Get multiple musical features for better transition detection
-    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-    beat_times = librosa.frames_to_time(beats, sr=sr)
+    beat_times = frame_times(features, features["beats"])
     
     # Onset strength for detecting musical changes
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
+    onset_env = features["onset_env"]
     
     # Spectral contrast for timbral changes
-    spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
+    spectral_contrast = features["contrast"]
     spectral_change = np.diff(np.mean(spectral_contrast, axis=0))
     
     # Combine features into a single novelty curve
@@ -77,27 +156,38 @@ def find_transition_points(filename, num_slides, transition_duration=1.5, fade_d
                                    pre_avg=10, post_avg=10, delta=0.2, wait=20)
     
     # Convert to time
-    frame_times = librosa.frames_to_time(np.arange(len(novelty)), sr=sr)
-    peak_times = frame_times[peaks]
+    novelty_times = frame_times(features, np.arange(len(novelty)))
+    peak_times = novelty_times[peaks]
     
     # Add beats that coincide with high novelty
     beat_novelty_threshold = np.percentile(novelty, 70)
-    significant_beats = []
-    for beat_time in beat_times:
-        closest_frame = np.argmin(np.abs(frame_times - beat_time))
-        if novelty[closest_frame] > beat_novelty_threshold:
-            significant_beats.append(beat_time)
+    significant_beats = beat_times[novelty[_nearest_indices(novelty_times, beat_times)] > beat_novelty_threshold]
     
     # Combine all candidate points
     all_candidates = np.unique(np.concatenate([peak_times, significant_beats]))
-    all_candidates = np.sort(all_candidates)
-    
+    return peak_times, np.sort(all_candidates)
+
+def spaced_slides(tempo, duration, peak_times, all_candidates, num_slides, transition_duration=1.5, fade_duration=3.0):
+    """
+    Return the find_transition_points timing of a track from its spaced_candidates.
+
+    Args:
+        tempo: Tempo of the track (BPM)
+        duration: Length of the track (seconds)
+        peak_times, all_candidates: As spaced_candidates returns them
+        num_slides: Number of slides to transition between
+        transition_duration: Duration of transitions between slides (seconds)
+        fade_duration: Duration of fade to black for final slide (seconds)
+    """
     # Select num_slides points with good spacing
-    duration = librosa.get_duration(y=y, sr=sr)
+    selected_indices = None
     if len(peak_times) > num_slides + 1:
-        # Use dynamic programming to find best spaced points
+        # Use dynamic programming to find best spaced points. Spacings are limited to 0.5-1.5x the
+        # ideal one, so candidates bunched into one part of the track fall back to even spacing
         print("using dynamic programming to select best spaced points")
-        selected_indices = _select_best_spaced_points(all_candidates, num_slides+1, duration)
+        selected_indices = _select_best_spaced_points(all_candidates, num_slides+1, duration,
+                                                      window=duration / (num_slides + 2) / 2)
+    if selected_indices is not None:
         transition_points = all_candidates[selected_indices]
     else:
         # Fall back to evenly spaced if not enough candidates
@@ -130,6 +220,24 @@ def find_transition_points(filename, num_slides, transition_duration=1.5, fade_d
     return {"tempo": tempo, "slides": slides}
     
 
+def find_transition_points(filename, num_slides, transition_duration=1.5, fade_duration=3.0):
+    """
+    Find optimal transition points in music based on rhythm, beats, and musical changes.
+    
+    Args:
+        filename: Path to audio file
+        num_slides: Number of slides to transition between
+        transition_duration: Duration of transitions between slides (seconds)
+        fade_duration: Duration of fade to black for final slide (seconds)
+    
+    Returns:
+        List of transition start times in seconds
+    """
+    features = load_features(filename)
+    peak_times, all_candidates = spaced_candidates(features)
+    return spaced_slides(float(features["tempo"][0]), float(features["duration"]), peak_times, all_candidates,
+                         num_slides, transition_duration, fade_duration)
+
 def analyze_audio_new(filename, num_slides, transition_duration=1.5, fade_duration=3.0):
     """
     Analyze audio file to determine slide transitions based on rhythm and musical changes.
@@ -147,27 +255,20 @@ def analyze_audio_new(filename, num_slides, transition_duration=1.5, fade_durati
     # json.dump(result_json, open(fname, "w"), indent=4)
     return result_json
 
-def analyze_audio(filename, num_slides, transition_duration=1.5, fade_duration=3.0):
-    y, sr = librosa.load(filename, sr=None)
-
-    # Calculate tempo and beats
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr)
-
-    # Calculate energy (RMS)
-    rms = librosa.feature.rms(y=y)[0]
-    rms_times = librosa.times_like(rms, sr=sr)
-
-    # Calculate novelty function (onset strength)
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-    novelty_times = librosa.times_like(onset_env, sr=sr)
+def onset_peaks(features):
+    """Return the times of the onset strength peaks analyze_audio spreads the slides over."""
+    # Novelty function (onset strength)
+    onset_env = features["onset_env"]
+    novelty_times = frame_times(features, np.arange(len(onset_env)))
 
     # Detect peaks in the onset strength to find possible transitions
     peak_indices = librosa.util.peak_pick(onset_env, pre_max=5, post_max=5, pre_avg=5, post_avg=5, delta=0.1, wait=10)
-    peak_times = novelty_times[peak_indices]
+    return novelty_times[peak_indices]
 
+def peak_slides(tempo, duration, peak_times, num_slides, transition_duration=1.5, fade_duration=3.0):
+    """Return the analyze_audio timing of a track from its onset_peaks, see analyze_audio."""
     # Add first and last time to ensure full coverage
-    peak_times = np.concatenate(([0.0], peak_times, [librosa.get_duration(y=y, sr=sr)]))
+    peak_times = np.concatenate(([0.0], peak_times, [duration]))
 
     # If there are more transitions than slides, reduce using linear spacing
     if len(peak_times) > num_slides + 1:
@@ -175,7 +276,7 @@ def analyze_audio(filename, num_slides, transition_duration=1.5, fade_duration=3
         peak_times = peak_times[indices]
     else:
         # If too few transitions, linearly interpolate
-        peak_times = np.linspace(0, librosa.get_duration(y=y, sr=sr), num_slides + 1)
+        peak_times = np.linspace(0, duration, num_slides + 1)
 
     # Build slide JSON with timings
     slides = []
@@ -193,6 +294,11 @@ def analyze_audio(filename, num_slides, transition_duration=1.5, fade_duration=3
 
     return {"tempo": tempo, "slides": slides}
 
+def analyze_audio(filename, num_slides, transition_duration=1.5, fade_duration=3.0):
+    features = load_features(filename)
+    return peak_slides(float(features["tempo"][0]), float(features["duration"]), onset_peaks(features),
+                       num_slides, transition_duration, fade_duration)
+
 # Example usage
 if __name__ == "__main__":
     # audio_file = sys.argv[1]
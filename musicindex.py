@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from analyze_music_slideshow import transition_candidates
+from musicanalyzer import spaced_candidates, onset_peaks
+from cacheutil import atomic_write
+from audiofeatures import load_features, frame_times, audio_hash, FEATURE_VERSION
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MUSIC_DIR = os.path.join(SCRIPT_DIR, 'downloads')
+INDEX_FILE = os.path.join(SCRIPT_DIR, 'music_index.json')
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a")
+# Seconds per value of the stored energy profile
+ENERGY_RESOLUTION = 1.0
+# Bump when the entries change so stale ones are re-analyzed
+INDEX_VERSION = 4
+
+# Parsed index files by path, with the modification time they were read at
+_loaded = {}
+
+def find_tracks(music_dir=MUSIC_DIR):
+    """Return every audio file below music_dir, sorted."""
+    tracks = []
+    for root, _, files in os.walk(music_dir):
+        for name in files:
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                tracks.append(os.path.abspath(os.path.join(root, name)))
+    return sorted(tracks)
+
+def _params():
+    return {"version": FEATURE_VERSION, "index_version": INDEX_VERSION}
+
+def _signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def analyze_track(audio_path):
+    """
+    Analyze one track and return its index entry.
+
+    Runs in a worker process. Loading the features also stores them in the feature cache, so
+    later renders of this track read them instead of decoding the audio. Beats, sections and
+    the candidates of every timing strategy are stored at full precision, so timing a slideshow
+    from the entry gives the same result as timing it from the features.
+    """
+    features = load_features(audio_path)
+    rms = features["rms"]
+    # Mean RMS energy per ENERGY_RESOLUTION seconds
+    bins = (frame_times(features, np.arange(len(rms))) // ENERGY_RESOLUTION).astype(int)
+    energy = np.bincount(bins, weights=rms) / np.maximum(np.bincount(bins), 1)
+    peaks = onset_peaks(features)
+    spaced_peaks, spaced = spaced_candidates(features)
+    return {
+        "file": audio_path,
+        "signature": _signature(audio_path),
+        "hash": audio_hash(audio_path),
+        "params": _params(),
+        "duration": float(features["duration"]),
+        "tempo": float(features["tempo"][0]),
+        "beats": frame_times(features, features["beats"]).tolist(),
+        "energy": np.round(energy, 5).tolist(),
+        "novelty_peaks": np.round(peaks, 3).tolist(),
+        "sections": frame_times(features, features["sections"]).tolist(),
+        "section_strength": np.asarray(features["section_strength"], dtype=float).tolist(),
+        "candidates": transition_candidates(features).tolist(),
+        "spaced_peaks": spaced_peaks.tolist(),
+        "spaced_candidates": spaced.tolist(),
+        "onset_peaks": peaks.tolist(),
+    }
+
+def load_index(index_file=INDEX_FILE):
+    """Return the index as a dict of entries keyed by absolute file path."""
+    if not os.path.exists(index_file):
+        return {}
+    try:
+        with open(index_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f"Warning: ignoring unreadable music index {index_file}")
+        return {}
+
+def save_index(index, index_file=INDEX_FILE):
+    with atomic_write(index_file) as f:
+        json.dump(index, f)
+
+def _is_current(entry, audio_path):
+    return (entry is not None
+            and entry["signature"] == _signature(audio_path)
+            and entry["params"] == _params())
+
+def track_info(audio_path, index_file=INDEX_FILE):
+    """Return the index entry of audio_path, or None if it is not indexed or changed since."""
+    audio_path = os.path.abspath(audio_path)
+    # Parse the index again only when it was rewritten
+    try:
+        mtime_ns = os.stat(index_file).st_mtime_ns
+    except OSError:
+        return None
+    if index_file not in _loaded or _loaded[index_file][0] != mtime_ns:
+        _loaded[index_file] = (mtime_ns, load_index(index_file))
+    entry = _loaded[index_file][1].get(audio_path)
+    return entry if _is_current(entry, audio_path) else None
+
+def build_index(music_dir=MUSIC_DIR, index_file=INDEX_FILE, workers=None, force=False):
+    """
+    Analyze every new or changed track in music_dir in parallel and update the index.
+
+    Tracks whose size and modification time are unchanged since they were indexed (with the
+    same index version) are skipped, and entries of deleted tracks are dropped.
+
+    Args:
+        music_dir: Directory searched (recursively) for audio files
+        index_file: JSON index to update
+        workers: Number of worker processes (default: CPU count)
+        force: Re-analyze every track
+
+    Returns:
+        The updated index
+    """
+    tracks = find_tracks(music_dir)
+    index = load_index(index_file)
+    for path in list(index):
+        if path.startswith(os.path.abspath(music_dir) + os.sep) and path not in tracks:
+            print(f"Removing deleted track {path}")
+            del index[path]
+
+    pending = [path for path in tracks if force or not _is_current(index.get(path), path)]
+    print(f"{len(tracks)} tracks in {music_dir}, {len(pending)} to analyze")
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(analyze_track, path): path for path in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                try:
+                    index[path] = future.result()
+                    print(f"[{done}/{len(pending)}] {os.path.basename(path)}: "
+                          f"{index[path]['duration']:.1f}s, {index[path]['tempo']:.1f} BPM")
+                except Exception as e:
+                    # Left out of the index so the next run retries it
+                    print(f"[{done}/{len(pending)}] Warning: could not analyze {path}: {type(e).__name__} {e}")
+    save_index(index, index_file)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze the music library into a persistent index')
+    parser.add_argument('music_dir', nargs='?', default=MUSIC_DIR, help='Music directory (default: %(default)s)')
+    parser.add_argument('--index', default=INDEX_FILE, help='Index file (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--force', action='store_true', help='Re-analyze every track')
+    args = parser.parse_args()
+
+    build_index(args.music_dir, args.index, args.workers, args.force)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import numpy as np
+from analyze_music_slideshow import track_analysis
+from musicindex import track_info
+from musicanalyzer import spaced_slides, peak_slides, _nearest_indices
+
+def _track_analysis(audio_path):
+    # From the music index when the track is indexed and unchanged, else from its audio features
+    return track_analysis(audio_path, track_info(audio_path))
+
+def _transitions(audio_path, num_slides, transition_time, fade_out_time):
+    analysis = _track_analysis(audio_path)
+    result = analysis.slides_for(num_slides, transition_time, fade_out_time)
+    return {"tempo": analysis.tempo, "slides": result["slides"]}
+
+def _spaced(audio_path, num_slides, transition_time, fade_out_time):
+    analysis = _track_analysis(audio_path)
+    return spaced_slides(analysis.tempo, analysis.duration, analysis.spaced_peaks, analysis.spaced_candidates,
+                         num_slides, transition_time, fade_out_time)
+
+def _peaks(audio_path, num_slides, transition_time, fade_out_time):
+    analysis = _track_analysis(audio_path)
+    return peak_slides(analysis.tempo, analysis.duration, analysis.onset_peaks, num_slides, transition_time, fade_out_time)
+
+# Music timing strategies by name. All time the slides from the track's analysis, read from the
+# music index when the track is indexed, else built once from its cached audio features.
+#   transitions: every 4th beat, onsets and spectral rolloff changes at least transition_time + 1s
+#                apart, spread evenly over the slides (analyze_music_slideshow)
+#   spaced:      novelty peaks and strong beats, chosen so the spacing is as even as possible
+#                (musicanalyzer.find_transition_points)
+#   peaks:       onset strength peaks spread evenly over the slides (musicanalyzer.analyze_audio)
+TIMING_STRATEGIES = {
+    "transitions": _transitions,
+    "spaced": _spaced,
+    "peaks": _peaks,
+}
+
+# Snapping and frame quantization never make a slide shorter than this (seconds)
+MIN_SLIDE_DURATION = 0.5
+# Slide changes within this many seconds of a beat are moved onto it
+BEAT_SNAP = 0.15
+
+def snap_to_sections(slides, sections, tolerance, total_duration):
+    """
+    Move slide changes onto nearby section boundaries.
+
+    Each boundary, strongest first, pulls the nearest slide change within tolerance seconds onto
+    it, unless that would reorder the slides or leave one shorter than MIN_SLIDE_DURATION. The
+    show keeps its total duration, only the slides either side of a moved change are resized.
+
+    Args:
+        slides: Slides as analyze_timing returns them (start, duration, transition)
+        sections: (times, strengths) of the section boundaries
+        tolerance: Largest move (seconds)
+        total_duration: End of the last slide's transition
+
+    Returns:
+        New list of slides
+    """
+    slides = [dict(slide) for slide in slides]
+    starts = np.array([slide["start"] for slide in slides], dtype=float)
+    transitions = np.array([slide["transition"] for slide in slides], dtype=float)
+    ends = np.append(starts[1:], total_duration)
+    snapped = set()
+    times, strengths = sections
+    for boundary in np.asarray(times)[np.argsort(strengths)[::-1]]:
+        if len(slides) < 2:
+            break
+        k = 1 + int(np.argmin(np.abs(starts[1:] - boundary)))
+        if k in snapped or abs(starts[k] - boundary) > tolerance:
+            continue
+        if (boundary - transitions[k - 1] - starts[k - 1] < MIN_SLIDE_DURATION
+                or ends[k] - transitions[k] - boundary < MIN_SLIDE_DURATION):
+            continue
+        starts[k] = ends[k - 1] = boundary
+        snapped.add(k)
+        for i in (k - 1, k):
+            slides[i]["start"] = round(float(starts[i]), 3)
+            slides[i]["duration"] = round(float(ends[i] - starts[i] - transitions[i]), 3)
+    return slides
+
+def quantize_slides(slides, fps, total_frames=None, beat_times=None, beat_snap=0.0):
+    """
+    Convert slide timing to whole video frames.
+
+    Slide changes within beat_snap seconds of a beat are moved onto it, then every start and
+    transition is rounded to a frame. The last slide ends exactly at total_frames, so the frames
+    of all slides and transitions add up to it, and starts are clamped so that every slide is
+    shown for at least MIN_SLIDE_DURATION (when total_frames leaves room for that).
+
+    Args:
+        slides: List of slides with duration and transition (and start) in seconds
+        fps: Frames per second of the video
+        total_frames: Length of the show in frames (default: the slides' own length, rounded)
+        beat_times: Sorted beat times (seconds) to snap slide changes to
+        beat_snap: Largest move onto a beat (seconds), 0 disables snapping
+
+    Returns:
+        New list of slides with start_frame, frames (shown before the transition) and
+        transition_frames, and start, duration and transition recomputed from them
+    """
+    n = len(slides)
+    transitions = np.array([int(round(slide["transition"] * fps)) for slide in slides])
+    lengths = np.array([slide["duration"] + slide["transition"] for slide in slides], dtype=float)
+    starts = np.concatenate(([0.0], np.cumsum(lengths)[:-1]))
+    if total_frames is None:
+        total_frames = int(round(np.sum(lengths) * fps))
+
+    if beat_times is not None and len(beat_times) and beat_snap > 0 and n > 1:
+        nearest = beat_times[_nearest_indices(beat_times, starts[1:])]
+        starts[1:] = np.where(np.abs(nearest - starts[1:]) <= beat_snap, nearest, starts[1:])
+    start_frames = np.rint(starts * fps).astype(int)
+    start_frames[0] = 0
+
+    # Earliest and latest start of every slide that leaves the slides around it their minimum
+    min_frames = int(round(MIN_SLIDE_DURATION * fps))
+    if total_frames < n * min_frames + transitions.sum():
+        min_frames = max((total_frames - transitions.sum()) // n, 0)
+    if total_frames < n * min_frames + transitions.sum():
+        raise ValueError(f"{n} slides with {transitions.sum()} transition frames do not fit in {total_frames} frames")
+    earliest = np.arange(n) * min_frames + np.concatenate(([0], np.cumsum(transitions)[:-1]))
+    latest = total_frames - (n - np.arange(n)) * min_frames - np.cumsum(transitions[::-1])[::-1]
+    start_frames = np.clip(start_frames, earliest, latest)
+    for k in range(1, n):
+        start_frames[k] = max(start_frames[k], start_frames[k - 1] + transitions[k - 1] + min_frames)
+
+    end_frames = np.append(start_frames[1:], total_frames)
+    quantized = []
+    for k, slide in enumerate(slides):
+        start_frame, transition_frames = int(start_frames[k]), int(transitions[k])
+        frames = int(end_frames[k]) - start_frame - transition_frames
+        quantized.append(dict(slide, start_frame=start_frame, frames=frames, transition_frames=transition_frames,
+                              start=round(start_frame / fps, 6), duration=round(frames / fps, 6),
+                              transition=round(transition_frames / fps, 6)))
+    return quantized
+
+def analyze_timing(audio_path, num_slides, transition_time=1.5, fade_out_time=3.0, strategy="transitions",
+                   section_snap=0.0, fps=24, beat_snap=BEAT_SNAP):
+    """
+    Time num_slides slides to the music with one of TIMING_STRATEGIES.
+
+    Every strategy returns the same structure. Slides play back to back, so each slide's start
+    is the sum of the durations and transitions before it; strategies whose first transition
+    point is after the start of the track have their first slide extended to begin at 0. The
+    timing is then quantized to whole video frames (see quantize_slides) with the last slide
+    ending with the music, so the frames of the show add up exactly to the audio length.
+
+    Args:
+        audio_path: Path to the audio file
+        num_slides: Number of slides
+        transition_time: Transition between slides (seconds)
+        fade_out_time: Fade out of the last slide (seconds)
+        strategy: Name of the strategy, see TIMING_STRATEGIES
+        section_snap: Move slide changes up to this many seconds onto section boundaries
+            (verse, chorus...) found when the features were cached; 0 disables snapping
+        fps: Frames per second of the video
+        beat_snap: Move slide changes up to this many seconds onto the nearest beat; 0 disables snapping
+
+    Returns:
+        {"strategy", "tempo", "fps", "total_frames", "total_duration", "sections": [section boundary times],
+         "slides": [{"slide", "start", "duration", "transition", "start_frame", "frames", "transition_frames"}, ...]}
+    """
+    if strategy not in TIMING_STRATEGIES:
+        raise ValueError(f"Unknown timing strategy '{strategy}'. Available: {', '.join(TIMING_STRATEGIES)}")
+    result = TIMING_STRATEGIES[strategy](audio_path, num_slides, transition_time, fade_out_time)
+
+    slides = []
+    start = 0.0
+    for index, slide in enumerate(result["slides"]):
+        duration = float(slide["duration"])
+        if index == 0 and slide.get("start", 0) > 0:
+            duration = round(duration + slide["start"], 3)
+        slides.append({"slide": index + 1, "start": round(start, 3), "duration": duration, "transition": float(slide["transition"])})
+        start += duration + slide["transition"]
+    total_duration = round(start, 3)
+
+    # Sections, beats and duration come from the memoized analysis, not the feature cache
+    analysis = _track_analysis(audio_path)
+    sections = (analysis.section_times, analysis.section_strength)
+    if section_snap > 0:
+        slides = snap_to_sections(slides, sections, section_snap, total_duration)
+    # Whole frames of audio, so the video never runs past the end of the music
+    total_frames = int(analysis.duration * fps)
+    slides = quantize_slides(slides, fps, total_frames, analysis.beat_times, beat_snap)
+    return {
+        "strategy": strategy,
+        "tempo": round(float(result["tempo"]), 2),
+        "fps": fps,
+        "total_frames": total_frames,
+        "total_duration": round(total_frames / fps, 6),
+        "sections": np.round(sections[0], 3).tolist(),
+        "slides": slides,
+    }
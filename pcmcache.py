@@ -0,0 +1,89 @@
+import glob
+import os
+import numpy as np
+import soundfile as sf
+from cacheutil import atomic_write, evict_lru
+from rendercache import file_hash
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PCM_CACHE_DIR = os.path.join(SCRIPT_DIR, 'pcm_cache')
+# Total size the decoded audio may take on disk before the least recently used tracks are evicted;
+# STORYGEN_PCM_CACHE_MB overrides it, 0 disables the cache
+PCM_CACHE_MAX_BYTES = int(float(os.environ.get("STORYGEN_PCM_CACHE_MB", "2048")) * 2 ** 20)
+# Samples decoded per read when filling the cache
+DECODE_BLOCK_SIZE = 1 << 18
+
+# In-process memo of content hashes keyed by (path, size, mtime) to avoid rehashing on every query
+_hash_memo = {}
+
+def audio_hash(audio_path):
+    """Return the content hash of an audio file, memoized while the file is unchanged."""
+    stat = os.stat(audio_path)
+    key = (os.path.abspath(audio_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _hash_memo:
+        _hash_memo[key] = file_hash(audio_path)
+    return _hash_memo[key]
+
+def _parse_entry(path):
+    # Entries are named <audio hash>.<sample rate>.<channels>.f32
+    _, sr, channels, _ = os.path.basename(path).split(".")
+    return int(sr), int(channels)
+
+def evict(max_bytes=PCM_CACHE_MAX_BYTES, keep=None):
+    """Delete the least recently used entries until the cache fits in max_bytes (never keep)."""
+    for path, size in evict_lru(os.path.join(PCM_CACHE_DIR, "*.f32"), max_bytes, keep):
+        print(f"Evicted decoded audio {os.path.basename(path)} ({size / 2 ** 20:.1f} MB)")
+
+def _decode(audio_path, prefix):
+    """Decode audio_path block by block into a new cache entry and return its path."""
+    os.makedirs(PCM_CACHE_DIR, exist_ok=True)
+    with sf.SoundFile(audio_path) as f:
+        sr, channels = f.samplerate, f.channels
+        path = f"{prefix}.{sr}.{channels}.f32"
+        with atomic_write(path, "wb") as out:
+            for block in f.blocks(blocksize=DECODE_BLOCK_SIZE, dtype="float32", always_2d=True):
+                out.write(np.ascontiguousarray(block).tobytes())
+    print(f"Decoded {os.path.basename(audio_path)} into the PCM cache ({os.path.getsize(path) / 2 ** 20:.1f} MB)")
+    return path
+
+def pcm_file(audio_path):
+    """
+    Return (path, sample_rate, channels) of the decoded audio of audio_path, decoding it on a miss.
+
+    The file holds the native rate, interleaved float32 samples exactly as soundfile decodes them
+    (ffmpeg reads it as "-f f32le"). Entries are keyed by content hash, so renames and
+    re-downloads of a track still hit, and every hit marks the entry as recently used.
+
+    Returns None when the cache is disabled or soundfile cannot decode the file.
+    """
+    if PCM_CACHE_MAX_BYTES <= 0:
+        return None
+    prefix = os.path.join(PCM_CACHE_DIR, audio_hash(audio_path))
+    existing = glob.glob(f"{prefix}.*.f32")
+    if existing:
+        path = existing[0]
+        try:
+            os.utime(path)
+            return (path,) + _parse_entry(path)
+        except OSError:
+            pass  # Evicted by another process, decode again
+    try:
+        path = _decode(audio_path, prefix)
+    except (sf.LibsndfileError, RuntimeError, OSError) as e:
+        print(f"Warning: not caching decoded audio of {audio_path} ({e})")
+        return None
+    evict(keep=path)
+    return (path,) + _parse_entry(path)
+
+def cached_pcm(audio_path):
+    """
+    Return (samples, sample_rate), samples being a read-only memmap of shape (frames, channels)
+    over the cached decode of audio_path, or None if it cannot be cached.
+    """
+    entry = pcm_file(audio_path)
+    if entry is None:
+        return None
+    path, sr, channels = entry
+    if os.path.getsize(path) == 0:
+        return np.zeros((0, channels), dtype=np.float32), sr
+    return np.memmap(path, dtype=np.float32, mode="r").reshape(-1, channels), sr
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import shutil
+from cacheutil import atomic_write
+
+# Bump when the render pipeline changes in a way that alters output for identical inputs
+RENDER_CACHE_VERSION = 2
+CACHE_INDEX_FILE = "render_cache.json"
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def render_fingerprint(image_files, music_file, params):
+    """
+    Fingerprint every input that affects a render.
+
+    Args:
+        image_files: Ordered list of slide images (hashed by content)
+        music_file: Music file (hashed by content) or None
+        params: Dict of timing, transition and encoder settings (must be JSON serialisable)
+    """
+    fingerprint = {
+        "version": RENDER_CACHE_VERSION,
+        "images": [file_hash(path) for path in image_files],
+        "music": file_hash(music_file) if music_file else None,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _index_path(output_file):
+    return os.path.join(os.path.dirname(os.path.abspath(output_file)), CACHE_INDEX_FILE)
+
+def _load_index(output_file):
+    index_path = _index_path(output_file)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f"Warning: ignoring unreadable render cache index {index_path}")
+        return {}
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def lookup(output_file, fingerprint):
+    """
+    Return the list of previously rendered files for fingerprint, or None.
+
+    Entries whose files were deleted or modified since they were recorded are ignored.
+    """
+    entry = _load_index(output_file).get(fingerprint)
+    if not entry:
+        return None
+    for output in entry["outputs"]:
+        if not os.path.exists(output["file"]) or _file_signature(output["file"]) != output["signature"]:
+            return None
+    return [output["file"] for output in entry["outputs"]]
+
+def store(output_file, fingerprint, output_files):
+    """Record the files produced for fingerprint in the render cache index next to output_file."""
+    index = _load_index(output_file)
+    index[fingerprint] = {
+        "outputs": [{"file": os.path.abspath(path), "signature": _file_signature(path)} for path in output_files],
+    }
+    with atomic_write(_index_path(output_file)) as f:
+        json.dump(index, f, indent=2)
+
+def reuse(cached_file, output_file):
+    """
+    Copy a cached render to output_file.
+
+    A copy rather than a hard link: renders overwrite their outputs in place, which would
+    otherwise also overwrite the cached render the output was linked to.
+    """
+    if os.path.abspath(cached_file) == os.path.abspath(output_file):
+        return output_file
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    shutil.copy2(cached_file, output_file)
+    print(f"Copied cached render {cached_file} -> {output_file}")
+    return output_file
@@ -0,0 +1,200 @@
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+# Shared no-op context returned while profiling is disabled, so instrumented code pays nothing
+_NULL_STAGE = nullcontext()
+
+_active = None
+
+def _peak_rss_mb():
+    """Return the peak resident memory of the process in MB, or None where it cannot be measured."""
+    try:
+        # Unix only
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        # peak_wset is the peak working set on Windows
+        return round(getattr(memory, "peak_wset", memory.rss) / (1024 * 1024), 1)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+def _child_cpu_time():
+    times = os.times()
+    return times.children_user + times.children_system
+
+class _Stage:
+    """Context manager measuring one stage of a render."""
+    def __init__(self, stats, name, frames):
+        self.stats = stats
+        self.name = name
+        self.frames = frames
+
+    def __enter__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_child_cpu = _child_cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.stages.append({
+            "name": self.name,
+            "start": round(self.start_wall - self.stats.start_wall, 6),
+            "wall_time": round(time.perf_counter() - self.start_wall, 6),
+            "cpu_time": round(time.process_time() - self.start_cpu, 6),
+            "child_cpu_time": round(_child_cpu_time() - self.start_child_cpu, 6),
+            "frames": self.frames,
+            "peak_rss_mb": _peak_rss_mb(),
+        })
+        return False
+
+class RenderStats:
+    """
+    Collects wall time, CPU time, frames produced and peak RSS for each stage of a render.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.transitions = []
+        self.start_wall = time.perf_counter()
+
+    def stage(self, name, frames=None):
+        return _Stage(self, name, frames)
+
+    def track_clip(self, name, clip):
+        """Wrap a clip's frame function so every frame it renders is timed and counted."""
+        record = {
+            "name": f"{name}#{len(self.transitions)}",
+            "start": None,
+            "end": None,
+            "wall_time": 0.0,
+            "cpu_time": 0.0,
+            "frames": 0,
+        }
+        self.transitions.append(record)
+        frame_function = clip.frame_function
+
+        def timed_frame_function(t):
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            frame = frame_function(t)
+            end_wall = time.perf_counter()
+            if record["start"] is None:
+                record["start"] = start_wall - self.start_wall
+            record["end"] = end_wall - self.start_wall
+            record["wall_time"] += end_wall - start_wall
+            record["cpu_time"] += time.process_time() - start_cpu
+            record["frames"] += 1
+            return frame
+
+        clip.frame_function = timed_frame_function
+        return clip
+
+    def report(self):
+        transitions = []
+        for record in self.transitions:
+            transitions.append({
+                "name": record["name"],
+                "wall_time": round(record["wall_time"], 6),
+                "cpu_time": round(record["cpu_time"], 6),
+                "frames": record["frames"],
+            })
+        return {
+            "name": self.name,
+            "total_wall_time": round(time.perf_counter() - self.start_wall, 6),
+            "peak_rss_mb": _peak_rss_mb(),
+            "stages": self.stages,
+            "transitions": transitions,
+        }
+
+    def trace_events(self):
+        """Return the stages and transitions as Chrome trace-event 'complete' events."""
+        pid = os.getpid()
+        events = []
+        for stage in self.stages:
+            events.append({
+                "name": stage["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": int(stage["start"] * 1e6),
+                "dur": int(stage["wall_time"] * 1e6),
+                "pid": pid,
+                "tid": 1,
+                "args": {key: stage[key] for key in ("cpu_time", "child_cpu_time", "frames", "peak_rss_mb")},
+            })
+        for record in self.transitions:
+            if record["start"] is None:
+                continue
+            events.append({
+                "name": record["name"],
+                "cat": "transition",
+                "ph": "X",
+                "ts": int(record["start"] * 1e6),
+                "dur": int((record["end"] - record["start"]) * 1e6),
+                "pid": pid,
+                "tid": 2,
+                "args": {
+                    "wall_time": round(record["wall_time"], 6),
+                    "cpu_time": round(record["cpu_time"], 6),
+                    "frames": record["frames"],
+                },
+            })
+        return events
+
+    def write_report(self, output_file, trace=False):
+        """
+        Write the report next to the rendered video.
+
+        Args:
+            output_file: Path of the rendered MP4, the report is written to <name>.render.json
+            trace: Also write a Chrome trace-event file to <name>.trace.json
+        """
+        base_name, _ = os.path.splitext(output_file)
+        report_file = base_name + ".render.json"
+        with open(report_file, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Render report written to {report_file}")
+        if trace:
+            trace_file = base_name + ".trace.json"
+            with open(trace_file, "w") as f:
+                json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
+            print(f"Render trace written to {trace_file}")
+        return report_file
+
+def enabled():
+    return _active is not None
+
+def start(name="render"):
+    """Enable profiling for this process. Returns the active RenderStats."""
+    global _active
+    if _active is None:
+        _active = RenderStats(name)
+    return _active
+
+def stop():
+    """Disable profiling and return the collected RenderStats (or None)."""
+    global _active
+    stats = _active
+    _active = None
+    return stats
+
+def stage(name, frames=None):
+    """Time a block of work as a named stage. A shared no-op when profiling is disabled."""
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name, frames)
+
+def track_clip(name, clip):
+    """Count and time the frames rendered by clip. Returns clip untouched when profiling is disabled."""
+    if _active is None:
+        return clip
+    return _active.track_clip(name, clip)
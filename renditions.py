@@ -0,0 +1,140 @@
+import os
+import subprocess
+import tempfile
+from moviepy.config import FFMPEG_BINARY
+from audiomux import audio_input_args, audio_output_args
+import renderstats
+
+# Named output presets. "suffix" is appended to the base output name.
+RENDITION_PRESETS = {
+    "full": {"format": "mp4", "suffix": "", "codec": "libx264", "preset": "medium", "crf": 20},
+    "720p": {"format": "mp4", "suffix": "_720p", "height": 720, "codec": "libx264", "preset": "veryfast", "bitrate": "2500k"},
+    "preview": {"format": "gif", "suffix": "_preview", "height": 240, "fps": 10},
+    "thumbnails": {"format": "strip", "suffix": "_thumbs", "height": 180, "columns": 8},
+}
+
+def resolve_renditions(renditions):
+    """Turn a list of preset names and/or rendition dicts into rendition dicts."""
+    resolved = []
+    for rendition in renditions:
+        if isinstance(rendition, str):
+            if rendition not in RENDITION_PRESETS:
+                raise ValueError(f"Unknown rendition '{rendition}'. Available: {', '.join(RENDITION_PRESETS)}")
+            rendition = dict(RENDITION_PRESETS[rendition], name=rendition)
+        resolved.append(rendition)
+    return resolved
+
+def rendition_file(output_file, rendition):
+    """Return the file a rendition is written to, derived from the base output file."""
+    base_name, ext = os.path.splitext(output_file)
+    extension = {"gif": ".gif", "strip": ".jpg"}.get(rendition.get("format", "mp4"), ext)
+    return f"{base_name}{rendition.get('suffix', '')}{extension}"
+
+def _video_filter(index, rendition, size, duration):
+    width, height = size
+    output_format = rendition.get("format", "mp4")
+    if rendition.get("height"):
+        # Never upscale beyond the source height, and keep it even for yuv420p
+        scale = f"scale=-2:'2*trunc(min({rendition['height']},ih)/2)'"
+    elif width % 2 or height % 2:
+        # yuv420p needs even dimensions
+        scale = "crop=trunc(iw/2)*2:trunc(ih/2)*2"
+    else:
+        scale = "null"
+
+    if output_format == "gif":
+        return (f"fps={rendition.get('fps', 10)},{scale},split[g{index}a][g{index}b];"
+                f"[g{index}a]palettegen[p{index}];[g{index}b][p{index}]paletteuse")
+    if output_format == "strip":
+        columns = rendition.get("columns", 8)
+        return f"fps={columns}/{duration:.3f},{scale},tile={columns}x1"
+    return scale
+
+def _output_args(rendition, output_file, audio_file, duration, audio_fade_out):
+    output_format = rendition.get("format", "mp4")
+    if output_format == "gif":
+        return ["-loop", "0", output_file]
+    if output_format == "strip":
+        return ["-frames:v", "1", "-update", "1", output_file]
+
+    args = ["-c:v", rendition.get("codec", "libx264"), "-pix_fmt", "yuv420p"]
+    if rendition.get("preset"):
+        args += ["-preset", rendition["preset"]]
+    if rendition.get("bitrate"):
+        args += ["-b:v", rendition["bitrate"]]
+    elif rendition.get("crf") is not None:
+        args += ["-crf", str(rendition["crf"])]
+    if audio_file:
+        args += ["-map", "1:a:0"] + audio_output_args(audio_file, output_file, duration, audio_fade_out)
+    args += ["-movflags", "+faststart", output_file]
+    return args
+
+def write_renditions(clip, output_file, renditions, fps=24, audio_file=None, audio_fade_out=0, frame_range=None):
+    """
+    Render every frame of clip once and fan it out to several encoders in a single ffmpeg process.
+
+    Frames are piped to ffmpeg as raw RGB and split inside its filter graph, so the extra
+    renditions only cost their own scaling and encoding.
+
+    Args:
+        clip: The composed MoviePy clip to render
+        output_file: Base output file, each rendition appends its suffix
+        renditions: List of preset names (see RENDITION_PRESETS) or rendition dicts
+        fps: Frames per second to render
+        audio_file: Optional music file muxed into the MP4 renditions
+        audio_fade_out: Duration of the music fade out at the end (in seconds)
+        frame_range: Optional (first, end) frame indices to render instead of the whole clip
+
+    Returns:
+        List of the files written
+    """
+    renditions = resolve_renditions(renditions)
+    width, height = clip.size
+    first_frame, end_frame = frame_range or (0, int(clip.duration * fps))
+    duration = (end_frame - first_frame) / fps
+
+    cmd = [FFMPEG_BINARY, "-y", "-loglevel", "error",
+           "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps),
+           "-i", "-"]
+    if audio_file:
+        cmd += audio_input_args(audio_file, output_file, audio_fade_out)
+
+    split_labels = "".join(f"[s{i}]" for i in range(len(renditions)))
+    filters = [f"[0:v]split={len(renditions)}{split_labels}"]
+    output_files = []
+    output_args = []
+    for i, rendition in enumerate(renditions):
+        filters.append(f"[s{i}]{_video_filter(i, rendition, clip.size, duration)}[o{i}]")
+        rendition_output = rendition_file(output_file, rendition)
+        output_files.append(rendition_output)
+        output_args += ["-map", f"[o{i}]"] + _output_args(rendition, rendition_output, audio_file, duration, audio_fade_out)
+    cmd += ["-filter_complex", ";".join(filters)] + output_args
+
+    print(f"Rendering {len(renditions)} renditions: {', '.join(output_files)}")
+    frames = 0
+    with renderstats.stage("write_renditions", frames=end_frame - first_frame), tempfile.TemporaryFile() as errors:
+        # ffmpeg's messages go to a file: a pipe nobody reads while frames are written could fill up and block it
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=errors)
+        try:
+            # Address frames by index so segment boundaries are exact
+            for frame_index in range(first_frame, end_frame):
+                frame = clip.get_frame(frame_index / fps)
+                if frame.dtype != "uint8":
+                    frame = frame.astype("uint8")
+                process.stdin.write(frame[:, :, :3].tobytes())
+                frames += 1
+        except BrokenPipeError:
+            # ffmpeg exited early, its exit code and messages below say why
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+        if process.returncode != 0:
+            errors.seek(0)
+            message = errors.read().decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"ffmpeg failed with exit code {process.returncode}: {message}")
+    print(f"Rendered {frames} frames into {len(output_files)} outputs")
+    return output_files
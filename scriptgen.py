@@ -7,21 +7,26 @@ from PIL import Image
 from automoviegen import create_slideshow
 from scriptomusic import get_best_track_for_script
 import glob
+import renderstats
+from llmcache import response_text, discard, set_fresh
 
 client = OpenAI()
 
 story_file = "rockstar_story.json"
 
-def fix_prompt(prompt):
-    response = client.responses.create(
+def _fix_prompt_request(prompt):
+    return dict(
         model="gpt-4.1",
         input="Please make a variation of the following prompt that would be less offensive and pass openAIs safety rules. \nIf the prompt says the person was overweight reword it into less offensive terms while keeping the meaning. \nReturn only the new prompt as a string. \n\nPrompt:" + prompt,
         temperature=0.7,
     )
-    return response.output_text.strip()
+
+def fix_prompt(prompt):
+    output_text = response_text(client, **_fix_prompt_request(prompt))
+    return output_text.strip()
     
 
-def send_prompt(prompt, prevImage, baseImage, base_image_prompt, feedback_image, iteration=0):
+def send_prompt(prompt, prevImage, baseImage, base_image_prompt, feedback_image, iteration=0, unfixed_prompt=None):
     try:
         if feedback_image and prevImage:
             result = client.images.edit(
@@ -44,10 +49,13 @@ def send_prompt(prompt, prevImage, baseImage, base_image_prompt, feedback_image,
             )
     except Exception as e:
         print(f"Error generating image: {e}")
+        if unfixed_prompt is not None:
+            # The fixed prompt was rejected too, so never reuse its cached variation
+            discard(**_fix_prompt_request(unfixed_prompt))
         if iteration < 3:
             fixed_prompt = fix_prompt(prompt)
             print(f"Retrying with a fixed prompt {fixed_prompt} ...")
-            return send_prompt(fixed_prompt, prevImage, baseImage, base_image_prompt, feedback_image, iteration + 1)
+            return send_prompt(fixed_prompt, prevImage, baseImage, base_image_prompt, feedback_image, iteration + 1, prompt)
         else:
             print("Failed to generate image after multiple attempts.")
         return None
@@ -61,7 +69,14 @@ def process_responsefile(response_file,
                          crossfade_time=1.5,
                          musichints="",
                          skip_image_gen=False, 
-                         feedback_image=False):
+                         feedback_image=False,
+                         profile=False,
+                         trace=False,
+                         renditions=None,
+                         use_render_cache=True,
+                         render_backend="moviepy",
+                         timing_strategy="transitions",
+                         section_snap=0.0):
     
     print(f"Story file: {story_file}")
     story = json.load(open(story_file, "r"))
@@ -98,59 +113,74 @@ def process_responsefile(response_file,
         baseImageDownSized = os.path.join(script_folder, "baseimage_downsized.png")
         img.resize((int(width/2), int(height/2)), Image.LANCZOS).save(baseImageDownSized)
 
-    if not skip_image_gen:
-        print("Generating images...")
-        for img_path in glob.glob("test-*.png", root_dir=script_folder):
-            try:
-                os.remove(os.path.join(script_folder, img_path))
-                print(f"Deleted {img_path}")
-            except OSError as e:
-                print(f"Error deleting {img_path}: {e}")
-        prevImage = None
-        for index, prompt in enumerate(response.get("image_prompts")):
-            print (f"Generating image with prompt: {prompt}")
-            result = send_prompt(prompt, prevImage, baseImageDownSized, base_image_prompt, feedback_image)
-            if not result:
-                continue
-            image_base64 = result.data[0].b64_json
-            image_bytes = base64.b64decode(image_base64)
-            imageFileName = f"test-{index+1}.png"
-            imageFileName = os.path.join(script_folder, imageFileName)
-            print(f"Image {imageFileName} generated successfully.")
-            # Save the image to a file
-            with open(imageFileName, "wb") as f:
-                f.write(image_bytes)
+    if profile:
+        renderstats.start(os.path.basename(mp4_file))
+
+    try:
+        if not skip_image_gen:
+            with renderstats.stage("generate_images"):
+                print("Generating images...")
+                for img_path in glob.glob("test-*.png", root_dir=script_folder):
+                    try:
+                        os.remove(os.path.join(script_folder, img_path))
+                        print(f"Deleted {img_path}")
+                    except OSError as e:
+                        print(f"Error deleting {img_path}: {e}")
+                prevImage = None
+                for index, prompt in enumerate(response.get("image_prompts")):
+                    print (f"Generating image with prompt: {prompt}")
+                    result = send_prompt(prompt, prevImage, baseImageDownSized, base_image_prompt, feedback_image)
+                    if not result:
+                        continue
+                    image_base64 = result.data[0].b64_json
+                    image_bytes = base64.b64decode(image_base64)
+                    imageFileName = f"test-{index+1}.png"
+                    imageFileName = os.path.join(script_folder, imageFileName)
+                    print(f"Image {imageFileName} generated successfully.")
+                    # Save the image to a file
+                    with open(imageFileName, "wb") as f:
+                        f.write(image_bytes)
                 
-            with Image.open(imageFileName) as img:
-                img = img.convert("RGB")
-                width, height = img.size
-                prevImage = os.path.join(script_folder, "previmage.png")
-                img.resize((int(width/2), int(height/2)), Image.LANCZOS).save(prevImage)
-
-        with open(baseImage, "rb") as f1:
-            image_bytes = f1.read()
-            # Save the image to a file
-            with open(os.path.join(script_folder, "test-0.png"), "wb") as f:
-                f.write(image_bytes)
-
-    best_music = None
-    if music_enabled:
-        numslides = 0
-        for img_path in glob.glob("test-*.png", root_dir=script_folder):
-            numslides += 1
-        best_music = get_best_track_for_script(response.get("script"), numslides=numslides, min_length=min_length, max_length=max_length, hints=musichints, refreshCache=False)
-        print(f"Using music: {best_music}")
+                    with Image.open(imageFileName) as img:
+                        img = img.convert("RGB")
+                        width, height = img.size
+                        prevImage = os.path.join(script_folder, "previmage.png")
+                        img.resize((int(width/2), int(height/2)), Image.LANCZOS).save(prevImage)
+
+                with open(baseImage, "rb") as f1:
+                    image_bytes = f1.read()
+                    # Save the image to a file
+                    with open(os.path.join(script_folder, "test-0.png"), "wb") as f:
+                        f.write(image_bytes)
+
+        best_music = None
+        if music_enabled:
+            numslides = 0
+            for img_path in glob.glob("test-*.png", root_dir=script_folder):
+                numslides += 1
+            with renderstats.stage("select_music"):
+                best_music = get_best_track_for_script(response.get("script"), numslides=numslides, min_length=min_length, max_length=max_length, hints=musichints, refreshCache=False)
+            print(f"Using music: {best_music}")
     
-    print(f"Script folder: {script_folder}")
-    print(f"Output MP4 file: {mp4_file}")
-    create_slideshow(
-            image_folder = script_folder, 
-            output_file = mp4_file,
-            image_pattern = "test-*.png",
-            music_enabled = music_enabled,
-            music_file = best_music,
-            crossfade_time = crossfade_time
-        )    
+        print(f"Script folder: {script_folder}")
+        print(f"Output MP4 file: {mp4_file}")
+        create_slideshow(
+                image_folder = script_folder, 
+                output_file = mp4_file,
+                image_pattern = "test-*.png",
+                music_enabled = music_enabled,
+                music_file = best_music,
+                crossfade_time = crossfade_time,
+                renditions = renditions,
+                use_cache = use_render_cache,
+                backend = render_backend,
+                timing_strategy = timing_strategy,
+                section_snap = section_snap
+            )
+    finally:
+        # Also after a failure, so a later run in this process is not left profiled without a report
+        if profile:
+            renderstats.stop().write_report(mp4_file, trace=trace)
         
             
 def script_gen(story_file, 
@@ -160,7 +190,14 @@ def script_gen(story_file,
                crossfade_time=1.5,
                musichints="",
                skip_image_gen=False, 
-               feedback_image=False):
+               feedback_image=False,
+               profile=False,
+               trace=False,
+               renditions=None,
+               use_render_cache=True,
+               render_backend="moviepy",
+               timing_strategy="transitions",
+               section_snap=0.0):
     response_file, ext = os.path.splitext(story_file)
     response_file = response_file + "_response" + ext
 
@@ -177,17 +214,18 @@ def script_gen(story_file,
     print(f"Base image prompt: {base_image_prompt}")
     
     print("Generating script...")
-    response = client.responses.create(
-        model="gpt-4.1",
-        input=base_prompt + prompt,
-        temperature=0.7,
-    )
+    output_text = response_text(client, model="gpt-4.1", input=base_prompt + prompt, temperature=0.7)
 
-    print(response.output_text)
-    jsonresponse = response.output_text.removeprefix("```json")
+    print(output_text)
+    jsonresponse = output_text.removeprefix("```json")
     jsonresponse = jsonresponse.removesuffix("```")
     jsonresponse = jsonresponse.replace("\'", "'")
-    response = json.loads(jsonresponse)
+    try:
+        response = json.loads(jsonresponse)
+    except ValueError:
+        # Do not reuse a script that cannot be parsed on the next run
+        discard(model="gpt-4.1", input=base_prompt + prompt, temperature=0.7)
+        raise
     json.dump(response, open(response_file, "w"), indent=4)
 
     process_responsefile(
@@ -199,7 +237,14 @@ def script_gen(story_file,
         crossfade_time=crossfade_time,
         musichints=musichints,
         skip_image_gen=skip_image_gen,
-        feedback_image=feedback_image
+        feedback_image=feedback_image,
+        profile=profile,
+        trace=trace,
+        renditions=renditions,
+        use_render_cache=use_render_cache,
+        render_backend=render_backend,
+        timing_strategy=timing_strategy,
+        section_snap=section_snap
     )
 
 
@@ -214,9 +259,20 @@ if __name__ == "__main__":
     parser.add_argument('--skip_image_gen', action='store_true', help='Skip image generation step', default=False)
     parser.add_argument('--feedback_image', action='store_true', help='Feedback previous image', default=False)
     parser.add_argument('--music_enabled', action='store_true', help='Enable music in the video', default=False)
+    parser.add_argument('--profile', action='store_true', help='Write a per-stage timing report next to the MP4', default=False)
+    parser.add_argument('--trace', action='store_true', help='Also write a Chrome trace-event file when profiling', default=False)
+    parser.add_argument('--renditions', type=str, help='Comma separated outputs rendered in one pass, e.g. full,720p,preview', default=None)
+    parser.add_argument('--no_render_cache', action='store_true', help='Always render, even if an identical render exists', default=False)
+    parser.add_argument('--render_backend', type=str, help='Render backend: moviepy, ffmpeg or segments', default="moviepy")
+    parser.add_argument('--timing_strategy', type=str, help='Music timing strategy: transitions, spaced or peaks', default="transitions")
+    parser.add_argument('--section_snap', type=float, help='Snap slide changes up to this many seconds onto song sections', default=0.0)
+    parser.add_argument('--fresh_llm', action='store_true', help='Ask the model again instead of reusing cached responses', default=False)
     
     args = parser.parse_args()
     print("music_enabled:", args.music_enabled)
+    if args.fresh_llm:
+        set_fresh()
+    renditions = args.renditions.split(",") if args.renditions else None
     
     if args.response_file:
         response_file = args.response_file
@@ -232,7 +288,14 @@ if __name__ == "__main__":
             crossfade_time=args.crossfade_time,
             musichints=args.musichints,
             skip_image_gen=args.skip_image_gen,
-            feedback_image=args.feedback_image
+            feedback_image=args.feedback_image,
+            profile=args.profile,
+            trace=args.trace,
+            renditions=renditions,
+            use_render_cache=not args.no_render_cache,
+            render_backend=args.render_backend,
+            timing_strategy=args.timing_strategy,
+            section_snap=args.section_snap
         )
     else:    
         script_gen(args.story_file,
@@ -242,4 +305,11 @@ if __name__ == "__main__":
                 args.crossfade_time,
                 args.musichints,
                 args.skip_image_gen, 
-                args.feedback_image)
+                args.feedback_image,
+                args.profile,
+                args.trace,
+                renditions,
+                not args.no_render_cache,
+                args.render_backend,
+                args.timing_strategy,
+                args.section_snap)
@@ -1,66 +1,24 @@
 import os
 import json
 import argparse
-import datetime
 import requests
+import httpclient
+from cacheutil import atomic_write
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
+from llmcache import response_text, discard
+from trackcatalog import load_catalog, download_metadata, download_genres, parse_duration, GENRE_MATCH_THRESHOLD, INCOMPETECH_URL
 
 client = OpenAI()
 # Get the directory of the current script
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-CACHE_FILE = os.path.join(SCRIPT_DIR, 'incompetech_metadata.json')
-GENRE_CACHE_FILE = os.path.join(SCRIPT_DIR, 'incompetech_genre.json')
-CACHE_TTL = datetime.timedelta(days=1)
-METADATA_URL = 'https://incompetech.com/music/royalty-free/pieces.json'
-GENRE_URL = 'https://incompetech.com/music/royalty-free/genre.json'
-BASE_MP3_URL = 'https://incompetech.com/music/royalty-free/mp3-royaltyfree/'
-
-def download_metadata(force=False):
-    """
-    Download and cache Incompetech metadata JSON.
-    """
-    if not force and os.path.exists(CACHE_FILE):
-        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(CACHE_FILE))
-        if datetime.datetime.now() - mtime < CACHE_TTL:
-            with open(CACHE_FILE, 'r') as f:
-                return json.load(f)
-    print("Fetching metadata from Incompetech...")
-    resp = requests.get(METADATA_URL)
-    resp.raise_for_status()
-    data = resp.json()
-    with open(CACHE_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
-    return data
-
-def download_genres(force:False):
-    """
-    Download and cache Incompetech genre JSON.
-    """
-    if not force and os.path.exists(GENRE_CACHE_FILE):
-        mtime = datetime.datetime.fromtimestamp(os.path.getmtime(GENRE_CACHE_FILE))
-        if datetime.datetime.now() - mtime < CACHE_TTL:
-            with open(GENRE_CACHE_FILE, 'r') as f:
-                return json.load(f)
-    print("Fetching genres from Incompetech...")
-    resp = requests.get(GENRE_URL)
-    resp.raise_for_status()
-    data = resp.json()
-    with open(GENRE_CACHE_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
-    return data
-
-def parse_duration(duration_str):
-    """
-    Convert duration string 'hh:mm:ss' or 'mm:ss' to seconds.
-    """
-    parts = list(map(int, duration_str.split(':')))
-    if len(parts) == 3:
-        h, m, s = parts
-    elif len(parts) == 2:
-        h = 0; m, s = parts
-    else:
-        return 0
-    return h * 3600 + m * 60 + s
+BASE_MP3_URL = INCOMPETECH_URL + 'mp3-royaltyfree/'
+# Metadata of each candidate track that find_track sends to the model
+PROMPT_FIELDS = ('filename', 'title', 'length', 'bpm', 'feel', 'instruments', 'description')
+# Longest description sent to the model
+PROMPT_DESCRIPTION_CHARS = 300
+# Recommended tracks downloaded at once, so the next is ready if the first cannot be used
+MP3_PREFETCH = 3
 
 def analyze_script(script, numslides, minlength, maxlength, hints):
     """
@@ -99,13 +57,9 @@ Respond in JSON format like this:
 }}
 ```
 """
-    response = client.responses.create(
-        model="gpt-4.1-nano",
-        input=prompt,
-        temperature=0.7,
-    )
+    output_text = response_text(client, model="gpt-4.1-nano", input=prompt, temperature=0.7)
     
-    jsonresponse = response.output_text.removeprefix("```json\n")
+    jsonresponse = output_text.removeprefix("```json\n")
     jsonresponse = jsonresponse.removesuffix("\n```")
     jsonresponse = jsonresponse.replace("\'", "'")
     
@@ -115,49 +69,10 @@ Respond in JSON format like this:
         return rec.get('mood'), rec.get('bpm'), rec.get('genre')
     except Exception:
         print("Warning: could not parse OpenAI response as JSON.")
+        discard(model="gpt-4.1-nano", input=prompt, temperature=0.7)
         return None, None, None
 
 
-def filter_tracks_by_length(tracks, min_len, max_len):
-    """
-    Filter tracks by duration to find the best fit within min_len and max_len.
-    """
-    if not tracks:
-        return tracks
-    
-    filtered_tracks = []
-    for track in tracks:
-        duration_str = track.get('length', '00:00:00')
-        duration_seconds = parse_duration(duration_str)
-        
-        # If both min and max are specified
-        if min_len and max_len:
-            if min_len <= duration_seconds <= max_len:
-                filtered_tracks.append(track)
-        # If only min is specified
-        elif min_len:
-            if duration_seconds >= min_len:
-                filtered_tracks.append(track)
-        # If only max is specified
-        elif max_len:
-            if duration_seconds <= max_len:
-                filtered_tracks.append(track)
-    
-    # If no tracks fit the criteria, find the closest one
-    if not filtered_tracks and tracks:
-        if min_len and max_len:
-            target = (min_len + max_len) / 2
-        elif min_len:
-            target = min_len
-        else:
-            target = max_len
-        
-        # Sort tracks by distance from target duration and take top 10
-        sorted_tracks = sorted(tracks, 
-                             key=lambda t: abs(parse_duration(t.get('length', '00:00:00')) - target))
-        filtered_tracks = sorted_tracks
-    return filtered_tracks[:10]
-    
 def find_best_genre(genre_names, genre, hints):
     """
     Use OpenAI to recommend search metadatabase for us.
@@ -184,28 +99,36 @@ hints:
 
 """
     print("Finding a best genre...")
-    response = client.responses.create(
-        model="gpt-4.1",
-        input=prompt,
-        temperature=0.7,
-    )
-    print("OpenAI response:", response.output_text)
-    jsonresponse = response.output_text.removeprefix("```json\n")
+    output_text = response_text(client, model="gpt-4.1", input=prompt, temperature=0.7)
+    print("OpenAI response:", output_text)
+    jsonresponse = output_text.removeprefix("```json\n")
     jsonresponse = jsonresponse.removesuffix("\n```")
     jsonresponse = jsonresponse.removesuffix("```")
     jsonresponse = jsonresponse.replace("\'", "'")
-    rec = json.loads(jsonresponse)
+    try:
+        rec = json.loads(jsonresponse)
+    except ValueError:
+        discard(model="gpt-4.1", input=prompt, temperature=0.7)
+        raise
     
     return rec["genre"]
 
 
     
-def find_track(metadata, mood, bpm, min_len, max_len, hints=None):
-    
-    filtered_metadata = filter_tracks_by_length(metadata, min_len, max_len) if min_len or max_len else metadata
-    
+def compact_track(track):
+    """Return the fields of a track the model chooses by, with its description shortened."""
+    compact = {field: track[field] for field in PROMPT_FIELDS if track.get(field)}
+    if len(compact.get('description', '')) > PROMPT_DESCRIPTION_CHARS:
+        compact['description'] = compact['description'][:PROMPT_DESCRIPTION_CHARS].rsplit(' ', 1)[0] + '...'
+    return compact
+
+def find_track(metadata, mood, bpm, hints=None, fresh=False):
     """
     Use OpenAI to recommend search metadatabase for us.
+
+    metadata holds the candidate tracks, already ranked locally (TrackCatalog.rank), and only
+    their compact fields are sent. The tracks of the response are replaced by the full metadata
+    of the candidates they name. fresh asks the model again rather than reusing its cached answer.
     """
         
     prompt = f"""You are a music recommendation engine specialized in Incompetech music.
@@ -217,7 +140,7 @@ If hints are provided bias using the hints.
 You must keep all tracks less than 3 minutes in length while maintaing the best match.
 
 metadata:
-{json.dumps(filtered_metadata, indent=None)}   
+{json.dumps([compact_track(track) for track in metadata], indent=None)}   
 
 mood:
 {mood}
@@ -231,14 +154,10 @@ Purely respond as JSON with an array named 'tracks' which is the metadata to the
 Ensure its valid json without any extra text or formatting.
 """
     print("Finding a track for the script...")
-    response = client.responses.create(
-        model="gpt-4.1",
-        input=prompt,
-        temperature=0.7,
-    )
-    print("OpenAI response:", response.output_text)
+    output_text = response_text(client, model="gpt-4.1", input=prompt, fresh=fresh, temperature=0.7)
+    print("OpenAI response:", output_text)
     
-    jsonresponse = response.output_text.removeprefix("```json\n")
+    jsonresponse = output_text.removeprefix("```json\n")
     jsonresponse = jsonresponse.removesuffix("\n```")
     jsonresponse = jsonresponse.removesuffix("```")
     jsonresponse = jsonresponse.replace("\'", "'")
@@ -246,6 +165,10 @@ Ensure its valid json without any extra text or formatting.
     try:
         rec = json.loads(jsonresponse)
         print(rec.get('reasoning'))
+        by_filename = {track.get('filename'): track for track in metadata}
+        by_title = {track.get('title'): track for track in metadata}
+        rec['tracks'] = [by_filename.get(track.get('filename')) or by_title.get(track.get('title')) or track
+                         for track in rec.get('tracks', []) if isinstance(track, dict)]
         return rec
     except Exception as e:
         print(f"Warning: could not parse OpenAI response as JSON. {e}")
@@ -264,58 +187,73 @@ def download_mp3(track, output_dir='downloads'):
     local_path = os.path.join(output_dir, filename)
     if not os.path.exists(local_path):
         print(f"Downloading {url}...")
-        resp = requests.get(url, stream=True)
-        resp.raise_for_status()
-        with open(local_path, 'wb') as f:
-            for chunk in resp.iter_content(chunk_size=1024):
-                f.write(chunk)
+        # Closing the response returns its connection to the pool
+        with httpclient.get(url, stream=True) as resp:
+            resp.raise_for_status()
+            # An interrupted download is never taken for the track
+            with atomic_write(local_path, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
     else:
         print(f"File {local_path} already exists, skipping download.")
     return local_path
 
 def get_best_track_for_script(script, numslides=0, min_length=None, max_length=None, hints=None, refreshCache=False):
-    metadata = download_metadata(force=refreshCache)
-    genres = download_genres(force=refreshCache)
-    # Convert genres from list to dict mapping index to genre name
-    genre_dict = {}
-    for genre_item in genres:
-        genre_dict[f"{genre_item['id']}"] = genre_item['genre']
-    for data in metadata:
-        genre_index = data.get("genre")
-        genre_name = genre_dict.get(genre_index)
-        data["genre"] = genre_name
-    
-    mood, bpm, genre = analyze_script(script, numslides=numslides, minlength=min_length, maxlength=max_length, hints=hints)
-    genre_names = genre_dict.values()
-    print(f"Available genres: {', '.join(genre_names)}")
-    
-    for retry_attempt in range(3):
-        best_genre = genre
-        if genre not in genre_names:
-            print(f"Genre '{genre}' not found in available genres. Finding closest match...")
-            best_genre = find_best_genre( {', '.join(genre_names)}, genre, hints)
-            print("Best genre found:", best_genre)
-            
-        best_genre_tracks = [track for track in metadata if track.get('genre') == best_genre]
+    """
+    Choose a track for the script, download it and return its path (None if none was found).
+
+    Loading the catalog (downloading the Incompetech JSON when stale) and analyzing the script
+    run at the same time, and the first MP3_PREFETCH recommended tracks are downloaded together,
+    so a track that cannot be downloaded falls back to the next without another wait.
+    """
+    executor = ThreadPoolExecutor(max_workers=MP3_PREFETCH)
+    try:
+        catalog_future = executor.submit(load_catalog, refresh=refreshCache)
+        analysis = executor.submit(analyze_script, script, numslides=numslides, minlength=min_length, maxlength=max_length, hints=hints)
+        catalog = catalog_future.result()
+        mood, bpm, genre = analysis.result()
+        genre_names = catalog.genre_names
+        print(f"Available genres: {', '.join(genre_names)}")
         
-        print(f"Recommended mood: {mood}, bpm: {bpm}, genre: {genre}")
-        best_tracks = find_track(best_genre_tracks, mood, bpm, min_length, max_length, hints)
-        if best_tracks:
-            tracks = best_tracks.get('tracks', [])
-            if tracks:
-                reasoning = best_tracks.get('reasoning')
-                print(f"Reasoning: \n {reasoning}\n")
-                track = tracks[0]
-                if track:
-                    print(f"Recommended track: \n {json.dumps(track, indent=2)}\n")
-                    path = download_mp3(track, os.path.join(SCRIPT_DIR, 'downloads'))
-                    if path:
-                        print("Downloaded:", path)
-                        return path
-                    else:
+        for retry_attempt in range(3):
+            best_genre, confidence = catalog.resolve_genre(genre)
+            if confidence < GENRE_MATCH_THRESHOLD:
+                print(f"Genre '{genre}' not found in available genres. Finding closest match...")
+                best_genre = find_best_genre(', '.join(genre_names), genre, hints)
+                print("Best genre found:", best_genre)
+                if best_genre in genre_names:
+                    catalog.remember_genre(genre, best_genre)
+            elif best_genre != genre:
+                print(f"Genre '{genre}' resolved to '{best_genre}' (confidence {confidence})")
+                
+            # Shortlist the genre locally so the prompt stays the same size however large the catalog
+            best_genre_tracks = catalog.rank(best_genre, " ".join(filter(None, [mood, hints])), bpm, min_length, max_length)
+            
+            print(f"Recommended mood: {mood}, bpm: {bpm}, genre: {genre}")
+            # Retries sample again, the cached answer already failed
+            best_tracks = find_track(best_genre_tracks, mood, bpm, hints, fresh=retry_attempt > 0)
+            if best_tracks:
+                tracks = [track for track in best_tracks.get('tracks', []) if track][:MP3_PREFETCH]
+                if tracks:
+                    reasoning = best_tracks.get('reasoning')
+                    print(f"Reasoning: \n {reasoning}\n")
+                    downloads = [executor.submit(download_mp3, track, os.path.join(SCRIPT_DIR, 'downloads')) for track in tracks]
+                    for track, download in zip(tracks, downloads):
+                        print(f"Recommended track: \n {json.dumps(track, indent=2)}\n")
+                        try:
+                            path = download.result()
+                        except (requests.RequestException, KeyError, OSError) as e:
+                            print(f"Failed to download track: {type(e).__name__} {e}")
+                            continue
+                        if path:
+                            print("Downloaded:", path)
+                            return path
                         print("Failed to download track.")
-        else:
-            print("No suitable tracks found, retrying...")
+            else:
+                print("No suitable tracks found, retrying...")
+    finally:
+        # Prefetches still running finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
 
     print("No suitable tracks.")
     return None
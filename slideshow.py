@@ -0,0 +1,409 @@
+import bisect
+import glob
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from moviepy import ImageClip, VideoClip, vfx
+from moviepy.config import FFMPEG_BINARY
+import numpy as np
+from PIL import Image, ImageFilter
+from musictiming import analyze_timing, quantize_slides
+from audiomux import mux_audio, audio_input_args, audio_output_args
+from renditions import write_renditions, resolve_renditions, rendition_file
+from transitions import apply_transition
+import rendercache
+import renderstats
+
+def find_images(image_folder, image_pattern="test-*.jpg,test-*.png"):
+    """
+    Return the images matching image_pattern (comma-separated patterns), sorted by their "test-N" index.
+    """
+    patterns = image_pattern.split(",")
+    image_files = []
+    for pattern in patterns:
+        image_files.extend(glob.glob(os.path.join(image_folder, pattern)))
+
+    # Sort the images based on their index in the filename
+    def extract_index(filename):
+        base = os.path.basename(filename)
+        try:
+            # Extract number between "test-" and file extension
+            index_str = base.split("test-")[1].split(".")[0]
+            return int(index_str)
+        except (IndexError, ValueError):
+            return float('inf')  # Files without proper index go to the end
+
+    image_files.sort(key=extract_index)
+    return image_files
+
+def resize_images(image_paths, exclude_from_height=None):
+    """
+    Resize all images in place to a common height, padding narrower ones with a blurred background.
+
+    Args:
+        image_paths: Images to resize
+        exclude_from_height: Optional filename suffix (e.g. "-0.png") of images that should not
+                             influence the common height
+    """
+    resized_images = []
+    max_height = 0
+
+    # Step 1: Resize all to max height, keeping aspect ratio
+    unchanged = set()
+    for path in image_paths:
+        with Image.open(path) as img:
+            if img.mode == "RGB":
+                unchanged.add(path)
+            img = img.convert("RGB")
+            width, height = img.size
+            if not (exclude_from_height and path.endswith(exclude_from_height)):
+                max_height = max(max_height, height)
+            resized_images.append((path, width, height, img))
+
+    # Determine final resized dimensions
+    resized_versions = []
+    max_width = 0
+
+    for path, orig_w, orig_h, img in resized_images:
+        new_width = int((max_height / orig_h) * orig_w)
+        max_width = max(max_width, new_width)
+        if max_height == orig_h:
+            resized_versions.append((path, img))
+            continue
+        print (f"Resizing {path} from {orig_w}x{orig_h} to max height {max_height}")
+        resized = img.resize((new_width, max_height), Image.LANCZOS)
+        resized_versions.append((path, resized))
+        unchanged.discard(path)
+
+    # Step 2: Add blurred borders to portrait images if needed
+    for path, resized in resized_versions:
+        width, height = resized.size
+        if width == max_width and path in unchanged:
+            # Already the final size, rewriting it would only churn the file (and the render cache)
+            continue
+        if width < max_width:
+            # Create blurred background
+            print (f"Adding blurred background to {path}")
+            blurred = resized.copy().resize((max_width, max_height), Image.LANCZOS)
+            blurred = blurred.filter(ImageFilter.GaussianBlur(radius=40))
+            # Paste resized image in center
+            offset_x = (max_width - width) // 2
+            blurred.paste(resized, (offset_x, 0))
+            final_img = blurred
+        else:
+            final_img = resized
+        # Save result
+        final_img.save(path)
+
+class FixedTiming:
+    """
+    Timing provider that shows every slide for the same time, independent of the music.
+    """
+    name = "fixed"
+
+    def __init__(self, slide_duration=2, crossfade_time=1, fade_out_time=3.0):
+        self.slide_duration = slide_duration
+        self.crossfade_time = crossfade_time
+        self.fade_out_time = fade_out_time
+
+    def slides(self, num_slides, music_file=None, fps=24):
+        slides = [{"duration": self.slide_duration, "transition": self.crossfade_time} for _ in range(num_slides - 1)]
+        slides.append({"duration": self.slide_duration, "transition": self.fade_out_time})  # Last slide fades out
+        slides = quantize_slides(slides, fps)
+        total_frames = sum(slide["frames"] + slide["transition_frames"] for slide in slides)
+        return {"slides": slides, "fps": fps, "total_frames": total_frames, "total_duration": total_frames / fps}
+
+    def cache_key(self):
+        return {"timing": self.name, "slide_duration": self.slide_duration,
+                "crossfade_time": self.crossfade_time, "fade_out_time": self.fade_out_time}
+
+class MusicTiming:
+    """
+    Timing provider that places transitions on musical features of the soundtrack, using one
+    of musictiming.TIMING_STRATEGIES.
+    """
+    name = "music"
+
+    def __init__(self, crossfade_time=1, fade_out_time=3.0, strategy="transitions", section_snap=0.0):
+        self.crossfade_time = crossfade_time
+        self.fade_out_time = fade_out_time
+        self.strategy = strategy
+        self.section_snap = section_snap
+
+    def slides(self, num_slides, music_file=None, fps=24):
+        return analyze_timing(music_file, num_slides, self.crossfade_time, self.fade_out_time, strategy=self.strategy,
+                              section_snap=self.section_snap, fps=fps)
+
+    def cache_key(self):
+        return {"timing": self.name, "strategy": self.strategy, "section_snap": self.section_snap,
+                "crossfade_time": self.crossfade_time, "fade_out_time": self.fade_out_time}
+
+def frames_duration(frames, fps):
+    """Return the shortest duration (seconds) of which MoviePy renders exactly frames frames at fps."""
+    duration = frames / fps
+    # MoviePy renders int(duration * fps) frames, which float rounding can leave one short
+    while int(duration * fps) < frames:
+        duration = float(np.nextafter(duration, np.inf))
+    return duration
+
+def _slide_frames(slide, fps):
+    # Whole frames shown before the transition, and of the transition (timings without frames are rounded)
+    frames = slide.get("frames", int(round(slide["duration"] * fps)))
+    transition_frames = slide.get("transition_frames", int(round(slide["transition"] * fps)))
+    return frames, transition_frames
+
+def concatenate_frames(parts, fps):
+    """
+    Play clips one after the other, each for a whole number of frames.
+
+    The part showing a frame is chosen by the frame index (round(t * fps)) against the integer
+    frame offsets of the parts, so frame n always comes from the part whose range holds n,
+    whatever the float rounding of n / fps or of the summed part durations.
+
+    Args:
+        parts: List of (clip, frames)
+        fps: Frames per second
+
+    Returns:
+        A clip of exactly the summed frames
+    """
+    parts = [(clip, frames) for clip, frames in parts if frames > 0]
+    starts = np.concatenate(([0], np.cumsum([frames for _, frames in parts]))).astype(int).tolist()
+    total_frames = starts[-1]
+
+    def frame_function(t):
+        frame_index = min(max(int(round(t * fps)), 0), total_frames - 1)
+        k = bisect.bisect_right(starts, frame_index) - 1
+        clip, _ = parts[k]
+        return clip.get_frame((frame_index - starts[k]) / fps)
+
+    return VideoClip(frame_function, duration=frames_duration(total_frames, fps))
+
+def build_timeline(image_files, slides, transition="ripple_transition", fps=24):
+    """
+    Compose the slideshow clip: every slide followed by a transition into the next one,
+    with the last slide fading out over its transition time.
+
+    Every slide and transition lasts its whole number of frames (the slides' frames and
+    transition_frames), see concatenate_frames.
+    """
+    frame_counts = [_slide_frames(slide, fps) for slide in slides[:len(image_files)]]
+    clips = []
+    for index, img in enumerate(image_files):
+        frames, transition_frames = frame_counts[index]
+        if index == len(image_files) - 1:
+            frames += transition_frames
+        clips.append((ImageClip(img).with_duration(frames / fps), frames))
+
+    parts = []
+    for i in range(len(clips) - 1):
+        clip1, frames1 = clips[i]
+        clip2, _ = clips[i + 1]
+        transition_frames = frame_counts[i][1]
+        parts.append((clip1, frames1))
+        if transition_frames:
+            parts.append((apply_transition(clip1, clip2, transition, transition_frames / fps), transition_frames))
+    last_clip, last_frames = clips[-1]
+    fade_out_frames = frame_counts[-1][1]
+    if fade_out_frames > 0:
+        parts.append((last_clip.with_effects([vfx.FadeOut(fade_out_frames / fps)]), last_frames))
+    else:
+        parts.append((last_clip, last_frames))
+
+    return concatenate_frames(parts, fps)
+
+def render_moviepy(job):
+    """Render with MoviePy's writer, then mux the music with ffmpeg."""
+    output_file = job["output_file"]
+    fps = job["fps"]
+    total_frames = job["total_frames"]
+    final_clip = job["clip"].with_duration(frames_duration(total_frames, fps))
+    if job["music_file"]:
+        # Render the video only, then trim/fade and mux the music with ffmpeg in one pass
+        base_name, ext = os.path.splitext(output_file)
+        video_file = f"{base_name}.noaudio{ext}"
+        with renderstats.stage("write_videofile", frames=total_frames):
+            final_clip.write_videofile(video_file, fps=fps, audio=False)
+        try:
+            with renderstats.stage("mux_audio"):
+                mux_audio(video_file, job["music_file"], output_file, total_frames / fps, fade_out=job["audio_fade_out"])
+        finally:
+            os.remove(video_file)
+    else:
+        with renderstats.stage("write_videofile", frames=total_frames):
+            final_clip.write_videofile(output_file, fps=fps, audio=False)
+    return [output_file]
+
+def render_ffmpeg(job):
+    """Pipe frames straight into ffmpeg, fanning out to every requested rendition."""
+    return write_renditions(job["clip"], job["output_file"], job["renditions"] or ["full"], fps=job["fps"],
+                            audio_file=job["music_file"], audio_fade_out=job["audio_fade_out"],
+                            frame_range=(0, job["total_frames"]))
+
+def _render_segment(image_files, slides, transition, segment_file, fps, frame_range):
+    # Runs in a worker process: rebuild the (lazy) timeline and encode only this frame range
+    clip = build_timeline(image_files, slides, transition, fps)
+    write_renditions(clip, segment_file, ["full"], fps=fps, frame_range=frame_range)
+    return segment_file
+
+def render_segments(job):
+    """
+    Split the timeline into contiguous frame ranges, encode them in parallel worker processes
+    and join them with ffmpeg's concat demuxer (no re-encode), muxing the music in the same pass.
+    """
+    fps = job["fps"]
+    total_frames = job["total_frames"]
+    workers = job["workers"] or os.cpu_count() or 1
+    bounds = [total_frames * i // workers for i in range(workers + 1)]
+    frame_ranges = [(bounds[i], bounds[i + 1]) for i in range(workers) if bounds[i + 1] > bounds[i]]
+
+    output_file = job["output_file"]
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as segment_dir:
+        segment_files = [os.path.join(segment_dir, f"segment_{i:03d}.mp4") for i in range(len(frame_ranges))]
+        with renderstats.stage("render_segments", frames=total_frames):
+            with ProcessPoolExecutor(max_workers=len(frame_ranges)) as executor:
+                futures = [executor.submit(_render_segment, job["image_files"], job["slides"], job["transition"],
+                                           segment_file, fps, frame_range)
+                           for segment_file, frame_range in zip(segment_files, frame_ranges)]
+                for future in futures:
+                    future.result()
+
+        list_file = os.path.join(segment_dir, "segments.txt")
+        with open(list_file, "w") as f:
+            for segment_file in segment_files:
+                f.write(f"file '{segment_file}'\n")
+
+        cmd = [FFMPEG_BINARY, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_file]
+        if job["music_file"]:
+            cmd += audio_input_args(job["music_file"], output_file, job["audio_fade_out"])
+            cmd += ["-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy"]
+            cmd += audio_output_args(job["music_file"], output_file, total_frames / fps, job["audio_fade_out"])
+        else:
+            cmd += ["-c:v", "copy"]
+        cmd += ["-movflags", "+faststart", output_file]
+        with renderstats.stage("concat_segments"):
+            subprocess.run(cmd, check=True)
+    return [output_file]
+
+# Render backends by name. Each takes a job dict and returns the list of files written.
+RENDER_BACKENDS = {
+    "moviepy": render_moviepy,
+    "ffmpeg": render_ffmpeg,
+    "segments": render_segments,
+}
+
+def create_slideshow(image_folder=".", output_file="slideshow.mp4", image_pattern="test-*.jpg,test-*.png",
+                     timing=None, music_file=None, transition="ripple_transition", backend="moviepy",
+                     renditions=None, audio_fade_out=0, fps=24, exclude_from_height=None,
+                     use_cache=True, profile=False, trace=False, workers=None):
+    """
+    Creates a slideshow video from images with transitions between them.
+
+    Args:
+        image_folder: Folder containing the images
+        output_file: Name of the output MP4 file
+        image_pattern: Pattern to match image files (comma-separated patterns)
+        timing: Timing provider (FixedTiming, MusicTiming, or any object with slides(num_slides, music_file, fps)
+                and cache_key())
+        music_file: Optional music file to add to the video
+        transition: Name of the transition (see transitions.apply_transition)
+        backend: Render backend name from RENDER_BACKENDS ("moviepy", "ffmpeg" or "segments")
+        renditions: Optional list of outputs rendered in a single pass (ffmpeg backend, the moviepy default
+                    switches to it, "segments" is rejected); "full" is added when no rendition writes output_file
+        audio_fade_out: Duration of the music fade out at the end (in seconds), 0 copies the music stream as-is
+        fps: Frames per second of the output
+        exclude_from_height: Filename suffix of images ignored when choosing the common height
+        use_cache: Reuse (copy) an earlier render with identical inputs instead of rendering again
+        profile: Record per-stage timings and write a <output>.render.json report next to the video
+        trace: Also write a Chrome trace-event file (<output>.trace.json) when profiling
+        workers: Number of worker processes for the "segments" backend (default: CPU count)
+
+    Returns:
+        The output file, or None if nothing was rendered
+    """
+    timing = timing or FixedTiming()
+    image_files = find_images(image_folder, image_pattern)
+    if not image_files:
+        print("No images found matching the pattern!")
+        return None
+
+    if renditions and backend == "segments":
+        raise ValueError("Renditions are rendered in one ffmpeg pass and cannot be combined with the 'segments' backend")
+    if renditions and backend != "ffmpeg":
+        print(f"Renditions require the ffmpeg backend, switching from '{backend}'")
+        backend = "ffmpeg"
+    if backend not in RENDER_BACKENDS:
+        raise ValueError(f"Unknown render backend '{backend}'. Available: {', '.join(RENDER_BACKENDS)}")
+
+    # Only own the profiling session if a caller (e.g. scriptgen) has not already started one
+    owns_profile = profile and not renderstats.enabled()
+    if owns_profile:
+        renderstats.start(os.path.basename(output_file))
+
+    try:
+        with renderstats.stage("resize_images"):
+            resize_images(image_files, exclude_from_height)
+
+        if renditions:
+            resolved_renditions = resolve_renditions(renditions)
+            # output_file is always written, it is what the caller gets back and reports against
+            if not any(rendition_file(output_file, rendition) == output_file for rendition in resolved_renditions):
+                resolved_renditions = resolve_renditions(["full"]) + resolved_renditions
+            output_files = [rendition_file(output_file, rendition) for rendition in resolved_renditions]
+        else:
+            resolved_renditions = None
+            output_files = [output_file]
+
+        if use_cache:
+            with renderstats.stage("render_fingerprint"):
+                fingerprint = rendercache.render_fingerprint(
+                    image_files, music_file,
+                    {
+                        "timing": timing.cache_key(),
+                        "audio_fade_out": audio_fade_out,
+                        "transition": transition,
+                        "fps": fps,
+                        "backend": backend,
+                        "renditions": resolved_renditions,
+                    })
+                cached_files = rendercache.lookup(output_file, fingerprint)
+            if cached_files:
+                print(f"Inputs unchanged since {cached_files[0]}, reusing the cached render")
+                for cached_file, new_file in zip(cached_files, output_files):
+                    rendercache.reuse(cached_file, new_file)
+                return output_file
+
+        with renderstats.stage(f"timing_{timing.name}"):
+            slide_timing = timing.slides(len(image_files), music_file, fps=fps)
+        slides = slide_timing.get("slides")
+
+        with renderstats.stage("build_timeline"):
+            final_clip = build_timeline(image_files, slides, transition, fps)
+        # Timing providers give the exact frame count; otherwise round the composed clip's duration
+        total_frames = slide_timing.get("total_frames") or int(round(final_clip.duration * fps))
+        print(f"Duration slides {slide_timing.get('total_duration', 0)} clips {final_clip.duration} frames {total_frames}")
+
+        job = {
+            "clip": final_clip,
+            "image_files": image_files,
+            "slides": slides,
+            "transition": transition,
+            "output_file": output_file,
+            "music_file": music_file,
+            "audio_fade_out": audio_fade_out,
+            "fps": fps,
+            "total_frames": total_frames,
+            "renditions": resolved_renditions,
+            "workers": workers,
+        }
+        RENDER_BACKENDS[backend](job)
+        print(f"Slideshow created successfully: {output_file}")
+
+        if use_cache:
+            rendercache.store(output_file, fingerprint, output_files)
+        return output_file
+    finally:
+        # Also after a failure, so the next render in this process starts its own session
+        if owns_profile:
+            renderstats.stop().write_report(output_file, trace=trace)
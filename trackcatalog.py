@@ -0,0 +1,489 @@
+import datetime
+import difflib
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from httpclient import fetch_file
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_FILE = os.path.join(SCRIPT_DIR, 'incompetech_metadata.json')
+GENRE_CACHE_FILE = os.path.join(SCRIPT_DIR, 'incompetech_genre.json')
+CACHE_TTL = datetime.timedelta(days=1)
+# Base of the Incompetech URLs; STORYGEN_INCOMPETECH_URL points it elsewhere, e.g. a local test server
+INCOMPETECH_URL = os.environ.get("STORYGEN_INCOMPETECH_URL", 'https://incompetech.com/music/royalty-free/')
+METADATA_URL = INCOMPETECH_URL + 'pieces.json'
+GENRE_URL = INCOMPETECH_URL + 'genre.json'
+CATALOG_DB = os.path.join(SCRIPT_DIR, 'incompetech_catalog.db')
+# Bump when the database layout changes; an older database is rebuilt from the JSON
+CATALOG_VERSION = 1
+# Tracks returned by a length or text query
+CLOSEST_TRACKS = 10
+# BM25 weights of the description, feel and instruments columns in text searches
+FTS_WEIGHTS = (1.0, 2.0, 0.5)
+# resolve_genre confidence below which the model should be asked instead
+GENRE_MATCH_THRESHOLD = 0.8
+# Words the script analysis uses for a style, by the Incompetech genre they belong to.
+# Only genres present in the catalog are used.
+GENRE_SYNONYMS = {
+    "Soundtrack": ["cinematic", "film", "film score", "score", "orchestral", "epic", "trailer", "ambient", "adventure"],
+    "Electronica": ["electronic", "edm", "techno", "house", "trance", "synth", "synthwave", "synthpop", "dance", "chiptune", "dubstep"],
+    "Horror": ["scary", "spooky", "creepy", "halloween", "dark ambient"],
+    "Mystery": ["suspense", "thriller", "noir", "detective", "tension"],
+    "Classical": ["baroque", "romantic", "symphonic", "chamber", "piano", "string quartet", "opera"],
+    "Jazz": ["swing", "bebop", "big band", "smooth jazz", "lounge"],
+    "Rock": ["metal", "punk", "indie", "grunge", "hard rock", "alternative"],
+    "Latin": ["salsa", "tango", "bossa nova", "samba", "mambo", "flamenco"],
+    "Reggae": ["ska", "dub", "dancehall"],
+    "Holiday": ["christmas", "xmas", "festive"],
+    "Comedy": ["funny", "cartoon", "children", "kids", "whimsical", "quirky"],
+    "World": ["ethnic", "folk", "celtic", "world music"],
+    "Contemporary": ["modern", "acoustic", "singer songwriter"],
+    "Pop": ["pop rock", "upbeat pop"],
+    "Blues": ["rhythm and blues", "delta blues"],
+    "Funk": ["soul", "groove", "r&b"],
+}
+# Candidates rank() returns for the model to choose from
+RANK_CANDIDATES = 20
+# BPM and length differences that cost as much as the best text match scores in rank()
+RANK_BPM_SCALE = 40.0
+RANK_LENGTH_SCALE = 30.0
+# Cost of an unknown BPM, in the same units
+RANK_UNKNOWN_BPM = 0.5
+
+def refresh_metadata(force=False):
+    """
+    Download the Incompetech metadata JSON if the cached copy is older than CACHE_TTL (or force).
+
+    Returns:
+        True if the cached copy changed
+    """
+    return fetch_file(METADATA_URL, CACHE_FILE, max_age=CACHE_TTL, force=force, check=json.loads)
+
+def refresh_genres(force=False):
+    """
+    Download the Incompetech genre JSON if the cached copy is older than CACHE_TTL (or force).
+
+    Returns:
+        True if the cached copy changed
+    """
+    return fetch_file(GENRE_URL, GENRE_CACHE_FILE, max_age=CACHE_TTL, force=force, check=json.loads)
+
+def download_metadata(force=False):
+    """
+    Download and cache Incompetech metadata JSON.
+    """
+    refresh_metadata(force)
+    with open(CACHE_FILE, 'r') as f:
+        return json.load(f)
+
+def download_genres(force=False):
+    """
+    Download and cache Incompetech genre JSON.
+    """
+    refresh_genres(force)
+    with open(GENRE_CACHE_FILE, 'r') as f:
+        return json.load(f)
+
+def parse_duration(duration_str):
+    """
+    Convert duration string 'hh:mm:ss' or 'mm:ss' to seconds.
+    """
+    parts = list(map(int, duration_str.split(':')))
+    if len(parts) == 3:
+        h, m, s = parts
+    elif len(parts) == 2:
+        h = 0; m, s = parts
+    else:
+        return 0
+    return h * 3600 + m * 60 + s
+
+def _parse_bpm(value):
+    try:
+        return int(round(float(value)))
+    except (TypeError, ValueError):
+        return None
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _track_key(track):
+    # The MP3 file name identifies a track; fall back to its title
+    return track.get('filename') or track.get('title') or json.dumps(track, sort_keys=True)
+
+def normalize_genre(name):
+    """Return a genre name lower-cased, with '&' spelled out and punctuation and extra spaces removed."""
+    name = (name or "").lower().replace("&", " and ")
+    return " ".join(re.findall(r"[a-z0-9]+", name))
+
+def _match_query(text):
+    # Any of the words, each quoted so FTS5 operators in the text are taken literally
+    return " OR ".join(f'"{word}"' for word in re.findall(r"\w+", text.lower()))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, signature TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS genres (id TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS genre_resolutions (query TEXT PRIMARY KEY, genre TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    genre_id TEXT,
+    duration INTEGER NOT NULL,
+    bpm INTEGER,
+    description TEXT,
+    feel TEXT,
+    instruments TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_genre_duration ON tracks (genre_id, duration);
+CREATE INDEX IF NOT EXISTS tracks_bpm ON tracks (bpm);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    description, feel, instruments, content='tracks', content_rowid='id', tokenize='porter unicode61');
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts (rowid, description, feel, instruments) VALUES (new.id, new.description, new.feel, new.instruments);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, description, feel, instruments) VALUES ('delete', old.id, old.description, old.feel, old.instruments);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, description, feel, instruments) VALUES ('delete', old.id, old.description, old.feel, old.instruments);
+    INSERT INTO tracks_fts (rowid, description, feel, instruments) VALUES (new.id, new.description, new.feel, new.instruments);
+END;
+"""
+
+def _locked(method):
+    # Run a method holding the catalog's lock, so no query runs on the shared connection while
+    # another thread is inside sync()'s transaction or between the statements of another query
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class TrackCatalog:
+    """
+    The Incompetech tracks in a SQLite database, kept in step with the downloaded JSON.
+
+    Lengths and BPMs are parsed once into typed, indexed columns next to the genre, and the
+    description, feel and instruments have a full-text index, so selecting the tracks of a genre
+    within a length range that match some words is one indexed query instead of parsing the
+    whole JSON. Call sync() to bring the database up to date with the JSON files.
+    """
+
+    def __init__(self, db_file=CATALOG_DB):
+        self.db_file = db_file
+        # Opened by whichever thread loads the catalog first, then used by the others in turn:
+        # every method using it holds lock
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+            # Older layout: start again, the next sync fills it from the JSON
+            self.conn.close()
+            os.remove(db_file)
+            self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+            self.conn.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+
+    @_locked
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def _source_changed(self, name, path):
+        row = self.conn.execute("SELECT signature FROM sources WHERE name = ?", (name,)).fetchone()
+        return row is None or json.loads(row[0]) != _signature(path)
+
+    def _set_source(self, name, path):
+        self.conn.execute("INSERT OR REPLACE INTO sources (name, signature) VALUES (?, ?)",
+                          (name, json.dumps(_signature(path))))
+
+    @_locked
+    def sync(self, metadata_file=CACHE_FILE, genre_file=GENRE_CACHE_FILE):
+        """
+        Update the database from the downloaded JSON files.
+
+        A file is only parsed when its size or modification time changed since the last sync,
+        and then only new, changed and removed tracks are written.
+
+        Returns:
+            True if anything was updated
+        """
+        updated = False
+        if self._source_changed('genres', genre_file):
+            with open(genre_file, 'r') as f:
+                genres = json.load(f)
+            with self.conn:
+                self.conn.execute("DELETE FROM genres")
+                self.conn.executemany("INSERT OR REPLACE INTO genres (id, name) VALUES (?, ?)",
+                                      [(str(item['id']), item['genre']) for item in genres])
+                self._set_source('genres', genre_file)
+            updated = True
+
+        if self._source_changed('metadata', metadata_file):
+            with open(metadata_file, 'r') as f:
+                metadata = json.load(f)
+            rows = {}
+            for track in metadata:
+                try:
+                    duration = parse_duration(track.get('length') or '00:00:00')
+                except ValueError:
+                    duration = 0
+                rows[_track_key(track)] = (str(track.get('genre')), duration, _parse_bpm(track.get('bpm')),
+                                           track.get('description'), track.get('feel'), track.get('instruments'),
+                                           json.dumps(track, sort_keys=True))
+            existing = dict(self.conn.execute("SELECT key, data FROM tracks"))
+            changed = [(key,) + row for key, row in rows.items() if existing.get(key) != row[-1]]
+            removed = [(key,) for key in existing if key not in rows]
+            with self.conn:
+                self.conn.executemany("DELETE FROM tracks WHERE key = ?", removed)
+                self.conn.executemany("""
+                    INSERT INTO tracks (key, genre_id, duration, bpm, description, feel, instruments, data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET genre_id = excluded.genre_id, duration = excluded.duration,
+                        bpm = excluded.bpm, description = excluded.description, feel = excluded.feel,
+                        instruments = excluded.instruments, data = excluded.data""", changed)
+                self._set_source('metadata', metadata_file)
+            print(f"Track catalog: {len(changed)} tracks added or changed, {len(removed)} removed, {len(rows)} in total")
+            updated = True
+        return updated
+
+    @property
+    @_locked
+    def genre_names(self):
+        """Genre names, in the order of the genre JSON."""
+        return [name for name, in self.conn.execute("SELECT name FROM genres ORDER BY rowid")]
+
+    @_locked
+    def resolve_genre(self, genre):
+        """
+        Match a genre name from the script analysis to a catalog genre without asking the model.
+
+        Tries, in order: an exact or normalized match, a resolution remembered with
+        remember_genre, the synonyms in GENRE_SYNONYMS, a catalog genre starting with the query,
+        a catalog genre or synonym named by some words of the query ("Dark Jazz"), then the
+        closest spelling.
+
+        Args:
+            genre: Genre name to resolve
+
+        Returns:
+            (catalog genre name, confidence between 0 and 1); below GENRE_MATCH_THRESHOLD the
+            model should be asked instead. (None, 0.0) when there is nothing to match.
+        """
+        names = self.genre_names
+        query = normalize_genre(genre)
+        if not names or not query:
+            return None, 0.0
+        if genre in names:
+            return genre, 1.0
+        by_normal = {normalize_genre(name): name for name in names}
+        # Plurals: "Soundtracks", "Holidays"
+        for candidate in (query, query.removesuffix("s")):
+            if candidate in by_normal:
+                return by_normal[candidate], 1.0
+
+        row = self.conn.execute("SELECT genre FROM genre_resolutions WHERE query = ?", (query,)).fetchone()
+        if row and row[0] in names:
+            return row[0], 1.0
+
+        synonyms = {normalize_genre(word): name for name, words in GENRE_SYNONYMS.items() if name in names for word in words}
+        if query in synonyms:
+            return synonyms[query], 0.95
+        # A genre whose name starts with the query ("Silent film")
+        for normal, name in by_normal.items():
+            if normal.startswith(query + " "):
+                return name, 0.9
+        # The words of the query, longest phrases first, naming a genre, else a synonym
+        words = query.split()
+        for size in range(len(words) - 1, 0, -1):
+            phrases = [" ".join(words[start:start + size]) for start in range(len(words) - size + 1)]
+            for phrase in phrases:
+                if phrase in by_normal:
+                    return by_normal[phrase], 0.9
+            for phrase in phrases:
+                if phrase in synonyms:
+                    return synonyms[phrase], 0.85
+
+        ratio, best = max((difflib.SequenceMatcher(None, query, normal).ratio(), name) for normal, name in by_normal.items())
+        return best, round(ratio, 3)
+
+    @_locked
+    def remember_genre(self, genre, resolved):
+        """Remember that genre resolves to the catalog genre resolved, for resolve_genre."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO genre_resolutions (query, genre) VALUES (?, ?)",
+                              (normalize_genre(genre), resolved))
+
+    @_locked
+    def _tracks(self, where="", params=(), order="t.id", limit=None, text=None):
+        sql = "SELECT t.data, g.name FROM tracks t LEFT JOIN genres g ON g.id = t.genre_id"
+        if text:
+            sql += " JOIN tracks_fts ON tracks_fts.rowid = t.id"
+            where = " AND ".join(filter(None, ["tracks_fts MATCH ?", where]))
+            params = (text,) + tuple(params)
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY " + order
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = tuple(params) + (limit,)
+        tracks = []
+        for data, genre in self.conn.execute(sql, params):
+            track = json.loads(data)
+            track['genre'] = genre
+            tracks.append(track)
+        return tracks
+
+    @staticmethod
+    def _filters(genre=None, min_len=None, max_len=None):
+        clauses, params = [], []
+        if genre is not None:
+            clauses.append("t.genre_id IN (SELECT id FROM genres WHERE name = ?)")
+            params.append(genre)
+        if min_len:
+            clauses.append("t.duration >= ?")
+            params.append(min_len)
+        if max_len:
+            clauses.append("t.duration <= ?")
+            params.append(max_len)
+        return " AND ".join(clauses), params
+
+    def genre_tracks(self, genre):
+        """Return the tracks of a genre, in catalog order."""
+        return self._tracks(*self._filters(genre))
+
+    def bpm_range(self, min_bpm, max_bpm, genre=None):
+        """Return the tracks (of genre, if given) whose BPM is within [min_bpm, max_bpm]."""
+        where, params = self._filters(genre)
+        where = " AND ".join(filter(None, ["t.bpm BETWEEN ? AND ?", where]))
+        return self._tracks(where, [min_bpm, max_bpm] + params, order="t.bpm")
+
+    def search(self, text, genre=None, min_len=None, max_len=None, limit=CLOSEST_TRACKS):
+        """
+        Return the tracks whose description, feel or instruments best match text.
+
+        Args:
+            text: Words to match (any of them, stemmed), e.g. "tense suspense"
+            genre: Genre name, or None for every genre
+            min_len: Minimum length in seconds
+            max_len: Maximum length in seconds
+            limit: Most tracks returned
+
+        Returns:
+            List of track metadata dicts, best match first
+        """
+        match = _match_query(text)
+        if not match:
+            return []
+        where, params = self._filters(genre, min_len, max_len)
+        order = f"bm25(tracks_fts, {', '.join(map(str, FTS_WEIGHTS))})"
+        return self._tracks(where, params, order=order, limit=limit, text=match)
+
+    @_locked
+    def find(self, genre=None, min_len=None, max_len=None, limit=CLOSEST_TRACKS):
+        """
+        Return the tracks of a genre that fit the length range.
+
+        Without a length range every track of the genre is returned. Otherwise the first limit
+        tracks that fit are returned or, when no track fits, the limit tracks closest to the middle
+        of the range.
+
+        Args:
+            genre: Genre name, or None for every track
+            min_len: Minimum length in seconds
+            max_len: Maximum length in seconds
+            limit: Most tracks returned when a length range is given
+
+        Returns:
+            List of track metadata dicts
+        """
+        if not min_len and not max_len:
+            return self.genre_tracks(genre)
+        tracks = self._tracks(*self._filters(genre, min_len, max_len), limit=limit)
+        if not tracks:
+            if min_len and max_len:
+                target = (min_len + max_len) / 2
+            else:
+                target = min_len or max_len
+            where, params = self._filters(genre)
+            tracks = self._tracks(where, params, order=f"ABS(t.duration - {float(target)}), t.id", limit=limit)
+        return tracks
+
+    @_locked
+    def rank(self, genre=None, text="", bpm=None, min_len=None, max_len=None, limit=RANK_CANDIDATES):
+        """
+        Return the limit tracks of a genre that best match text, bpm and the length range.
+
+        Each track scores its BM25 match of text over description, feel and instruments, scaled
+        so the best match in the genre scores 1, minus its distance from bpm (RANK_BPM_SCALE
+        BPM away costs 1) and its distance outside the length range (RANK_LENGTH_SCALE seconds
+        costs 1). SQLite scores every track of the genre (through the genre index, so the work
+        grows with the genre rather than the whole catalog) and returns only the ids of the best
+        limit, and only those tracks are decoded.
+
+        Args:
+            genre: Genre name, or None for every genre
+            text: Words describing the wanted music (mood, hints)
+            bpm: Wanted tempo, or None to ignore tempo
+            min_len: Minimum length in seconds
+            max_len: Maximum length in seconds
+            limit: Most tracks returned
+
+        Returns:
+            List of track metadata dicts, best first
+        """
+        where, params = self._filters(genre)
+        match = _match_query(text or "")
+        bpm = _parse_bpm(bpm)
+        # A query matching nothing when there are no words
+        params = [match or '""'] + params
+        sql = "WITH m AS ("
+        sql += f"SELECT rowid, -bm25(tracks_fts, {', '.join(map(str, FTS_WEIGHTS))}) AS score FROM tracks_fts WHERE tracks_fts MATCH ?"
+        sql += "), s AS (SELECT t.id, t.duration, t.bpm, m.score FROM tracks t LEFT JOIN m ON m.rowid = t.id"
+        if where:
+            sql += " WHERE " + where
+        sql += "), best AS (SELECT MAX(COALESCE(MAX(score), 0.0), 0.0) AS score FROM s)"
+        # Text match scaled to the best one, minus the tempo and length penalties
+        score = "CASE WHEN s.score <> 0 AND best.score > 0 THEN s.score / best.score ELSE 0.0 END"
+        if bpm is not None:
+            score += f" - CASE WHEN s.bpm IS NULL THEN {RANK_UNKNOWN_BPM} ELSE ABS(s.bpm - ?) / {RANK_BPM_SCALE} END"
+            params.append(bpm)
+        if min_len:
+            score += f" - CASE WHEN s.duration < ? THEN (? - s.duration) / {RANK_LENGTH_SCALE} ELSE 0.0 END"
+            params += [min_len, min_len]
+        if max_len:
+            score += f" - CASE WHEN s.duration > ? THEN (s.duration - ?) / {RANK_LENGTH_SCALE} ELSE 0.0 END"
+            params += [max_len, max_len]
+        sql += f" SELECT s.id FROM s, best ORDER BY {score} DESC, s.id LIMIT ?"
+        ids = [track_id for track_id, in self.conn.execute(sql, params + [limit])]
+        if not ids:
+            return []
+        order = "CASE t.id " + " ".join(f"WHEN {track_id} THEN {k}" for k, track_id in enumerate(ids)) + " END"
+        return self._tracks(f"t.id IN ({', '.join('?' * len(ids))})", ids, order=order)
+
+# Catalog of this process
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def load_catalog(refresh=False):
+    """
+    Return the track catalog, opening it once per process.
+
+    The Incompetech JSON is requested again when refresh is set or it is older than CACHE_TTL
+    (the metadata and genres in parallel, conditionally so an unchanged file costs a 304), and the database is synced whenever the JSON files
+    changed (here or in another process).
+    """
+    global _catalog
+    with _catalog_lock:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            downloads = [executor.submit(refresh_metadata, refresh), executor.submit(refresh_genres, refresh)]
+            for download in downloads:
+                download.result()
+        if _catalog is None:
+            _catalog = TrackCatalog()
+        _catalog.sync()
+        return _catalog
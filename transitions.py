@@ -1,5 +1,6 @@
 import numpy as np
 from moviepy import VideoClip, CompositeVideoClip, vfx
+import renderstats
 
 
 def wipe_left(clip1, clip2, duration=1.0):
@@ -1012,7 +1013,9 @@ def apply_transition(clip1, clip2, transition_name="fade", duration=1.0, **kwarg
         A clip to use as a transition between clip1 and clip2
     """
     if transition_name in transitions:
-        return transitions[transition_name](clip1, clip2, duration, **kwargs)
+        transition_clip = transitions[transition_name](clip1, clip2, duration, **kwargs)
     else:
         print(f"Transition '{transition_name}' not found. Using ripple_transition.")
-        return ripple_transition(clip1, clip2, duration)
\ No newline at end of file
+        transition_name = "ripple_transition"
+        transition_clip = ripple_transition(clip1, clip2, duration)
+    return renderstats.track_clip(transition_name, transition_clip)
\ No newline at end of file